@@ -1,32 +1,73 @@
+import time
+
+# 起動時間の計測用(他のモジュールの読み込み前に記録する)
+STARTUP_BEGIN = time.perf_counter()
+
 import argparse
+import array
 import csv
+import glob
+import hashlib
+import io
 import json
 import os
 import random
+import select
 import sqlite3
 import sys
-from contextlib import contextmanager
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from functools import wraps
+from urllib.request import pathname2url
 
 from dotenv import load_dotenv
 from flask import (
     Flask,
+    Request,
+    Response,
     abort,
+    before_render_template,
     flash,
+    g,
+    has_request_context,
     jsonify,
     redirect,
     render_template,
     request,
     send_from_directory,
     session,
+    template_rendered,
     url_for,
 )
-from jsonschema import SchemaError, ValidationError, validate
+from markupsafe import escape
 from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.serving import is_running_from_reloader
+
+from profiler import ProfiledConnection, Profiler
+from scenario_format import (
+    ALIAS,
+    EXTENSION,
+    CompiledScenario,
+    build_alias_table,
+    is_compiled,
+    next_targets,
+    pick_next_scene,
+    play_random,
+    validate_json,
+)
+from template_cache import TemplateBytecodeCache, warm_template_cache
 
 load_dotenv()
 
 
+def get_bundle_folder():
+    """実行ファイル化した場合に同梱したデータが展開されるフォルダ"""
+    return getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__)))
+
+
 def get_image_folder(image_base):
     if getattr(sys, "frozen", False):
         return os.path.join(os.path.dirname(sys.executable), image_base)
@@ -51,45 +92,338 @@ def define_argparse():
     parser.add_argument(
         "--registrable", action="store_true", help="ユーザ登録機能有効化"
     )
+    parser.add_argument(
+        "-w", "--watch", help="変更を監視して自動で取り込むシナリオのフォルダ"
+    )
+    parser.add_argument(
+        "--startup-time", action="store_true", help="起動にかかった時間を表示"
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        default=os.getenv("SNAPSHOT", "False").lower() in ("true", "1"),
+        help="シナリオを読み取り専用のDBファイルに書き出してプレイ時に使用",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=int(os.getenv("SHARDS", 0)),
+        help="プレイ履歴を分割して保存するDBファイルの数(0の場合は分割しない)",
+    )
 
     return parser.parse_args()
 
 
+class InMemoryRequest(Request):
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        # アップロードファイルを一時ファイルに書き出さずメモリ上で扱う
+        # (サイズの上限はMAX_CONTENT_LENGTHで制限される)
+        return io.BytesIO()
+
+
 def init_app():
     app = Flask(__name__)
+    app.request_class = InMemoryRequest
     app.config["ARGS"] = define_argparse()
     app.secret_key = os.getenv("SECRET_KEY", os.urandom(24))
     app.config["MAX_CONTENT_LENGTH"] = int(
         os.getenv("MAX_CONTENT_LENGTH", 1 * (1024**2))
     )
-    app.config["UPLOAD_FOLDER"] = os.getenv("UPLOAD_FOLDER", "temp")
-    app.config["DEBUG"] = os.getenv("DEBUG", False)
+    app.config["JOB_WORKERS"] = int(os.getenv("JOB_WORKERS", 2))
+    app.config["JOB_RETENTION_DAYS"] = int(os.getenv("JOB_RETENTION_DAYS", 7))
+    app.config["SAVE_SLOTS"] = int(os.getenv("SAVE_SLOTS", 3))
+    app.config["LIVE_BUFFER_SIZE"] = int(os.getenv("LIVE_BUFFER_SIZE", 256))
+    app.config["PROFILE"] = os.getenv("PROFILE", "False").lower() in ("true", "1")
+    app.config["PROFILE_BUFFER_SIZE"] = int(os.getenv("PROFILE_BUFFER_SIZE", 50))
+    app.config["SNAPSHOT_MMAP_SIZE"] = int(
+        os.getenv("SNAPSHOT_MMAP_SIZE", 256 * (1024**2))
+    )
+    app.config["DEBUG"] = os.getenv("DEBUG", "False").lower() in ("true", "1")
+    # 本番環境ではテンプレートの更新を確認しない
+    app.config["TEMPLATES_AUTO_RELOAD"] = app.config["DEBUG"]
+    app.config["TEMPLATE_CACHE"] = os.getenv("TEMPLATE_CACHE", "template_cache")
     app.config["IMAGE_BASE"] = os.getenv("IMAGE_FOLDER", "images")
     app.config["IMAGE_FOLDER"] = get_image_folder(app.config["IMAGE_BASE"])
+    app.config["WATCH_INTERVAL"] = float(os.getenv("WATCH_INTERVAL", 2))
+    app.config["WATCH_DEBOUNCE"] = float(os.getenv("WATCH_DEBOUNCE", 1))
 
-    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+    # テンプレートのコンパイル結果をディスクに保存して再起動後も再利用する
+    # (実行ファイル化した場合は同梱したコンパイル済みテンプレートを使用)
+    template_cache = os.path.join(get_bundle_folder(), "template_cache")
+    if not (getattr(sys, "frozen", False) and os.path.isdir(template_cache)):
+        template_cache = app.config["TEMPLATE_CACHE"]
+        os.makedirs(template_cache, exist_ok=True)
+    app.jinja_env.bytecode_cache = TemplateBytecodeCache(template_cache)
 
     return app
 
 
+def report_startup(stage):
+    if app.config["ARGS"].startup_time:
+        print(f"Startup ({stage}): {time.perf_counter() - STARTUP_BEGIN:.3f}s")
+
+
 app = init_app()
 
+# DBのスキーマのバージョン(init_dbでテーブル等を変更した場合は値を上げること)
+SCHEMA_VERSION = 7
+# シナリオ取り込み時に途中コミットするシーン数
+IMPORT_BATCH_SIZE = 500
+# 同じDBを使う他のプロセスと区別するためのID
+PROCESS_ID = uuid.uuid4().hex
+# 実行中のジョブや取り込み中のバージョンの生存を記録する間隔(秒)
+HEARTBEAT_INTERVAL = 10
+# 生存の記録がこの時間(秒)途絶えたジョブやバージョンは中断されたものとみなす
+LEASE_TIMEOUT = 60
+
+
+def shard_path(db_url, shard):
+    root, ext = os.path.splitext(db_url)
+    return f"{root}.shard{shard}{ext}"
+
+
+def snapshot_path(db_url, generation):
+    root, ext = os.path.splitext(db_url)
+    return f"{root}.content.{generation}{ext}"
+
+
+def snapshot_pointer(db_url):
+    """現在のスナップショットのファイル名を記録するファイル"""
+    root, _ = os.path.splitext(db_url)
+    return f"{root}.content"
+
+
+def current_snapshot(db_url):
+    try:
+        with open(snapshot_pointer(db_url), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(os.path.dirname(db_url), name) if name else None
+
+
+def sqlite_uri(path, **params):
+    uri = f"file:{pathname2url(os.path.abspath(path))}"
+    if params:
+        uri += "?" + "&".join(f"{key}={value}" for key, value in params.items())
+    return uri
+
+
+# スナップショットに書き出すシナリオのテーブル
+CONTENT_TABLES = (
+    "scenarios",
+    "scenario_versions",
+    "scenes",
+    "selections",
+    "next_scenes",
+)
+
+
+profiler = Profiler(app.config["PROFILE_BUFFER_SIZE"], app.config["PROFILE"])
+
+
+def request_profile():
+    """計測中のリクエストの計測結果(計測していない場合は None)"""
+    if not profiler.enabled or not has_request_context():
+        return None
+    return g.get("profile")
+
+
+def profile_stage(name):
+    profile = request_profile()
+    return profile.stage(name) if profile else nullcontext()
+
+
+def hash_password(password):
+    with profile_stage("kdf"):
+        return generate_password_hash(password)
+
+
+def verify_password(password_hash, password):
+    with profile_stage("kdf"):
+        return check_password_hash(password_hash, password)
+
+
+class Connection(sqlite3.Connection):
+    """コミットの成功後に実行する処理を登録できる接続"""
+
+
+def after_commit(conn, func, *args, **kwargs):
+    """トランザクションのコミットが成功した後に func を実行する
+
+    ロールバックされた場合は実行しない
+    """
+    conn.after_commit.append(lambda: func(*args, **kwargs))
+
+
+def run_after_commit(conn):
+    hooks, conn.after_commit = conn.after_commit, []
+    for hook in hooks:
+        hook()
+
+
+def connect(db_url, shard=None, snapshot=False):
+    """DBに接続する
+
+    shard を指定した場合はシャードのDBに接続し、シナリオやユーザ等の
+    共通のテーブルは読み取り専用で content として参照できるようにする
+    snapshot を指定した場合はシナリオのテーブルをスナップショットから読み込む
+    """
+    path = db_url if shard is None else shard_path(db_url, shard)
+    # 計測中のリクエストからの接続は実行した文を記録する
+    profile = request_profile()
+    conn = sqlite3.connect(
+        sqlite_uri(path),
+        uri=True,
+        factory=ProfiledConnection if profile else Connection,
+    )
+    conn.after_commit = []
+    if profile:
+        conn.profiler = profiler
+        conn.profile = profile
+    if shard is not None:
+        conn.execute(
+            "ATTACH DATABASE ? AS content", (sqlite_uri(db_url, mode="ro"),)
+        )
+    snapshot = snapshot and app.config["ARGS"].snapshot and current_snapshot(db_url)
+    if snapshot and os.path.exists(snapshot):
+        # スナップショットは置き換えられるだけで書き換えられないため
+        # ロックや変更の確認を行わずにメモリマップで読み込む
+        conn.execute(
+            "ATTACH DATABASE ? AS snapshot", (sqlite_uri(snapshot, immutable=1),)
+        )
+        conn.execute(f"PRAGMA snapshot.mmap_size = {app.config['SNAPSHOT_MMAP_SIZE']}")
+        # 一時ビューは他のスキーマより優先して参照される
+        for table in CONTENT_TABLES:
+            conn.execute(f"CREATE TEMP VIEW {table} AS SELECT * FROM snapshot.{table}")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# スナップショットの書き出しを待つ時間の上限(秒)
+SNAPSHOT_LOCK_TIMEOUT = 600
+
+
+@contextmanager
+def snapshot_lock(db_url):
+    """スナップショットの書き出しを他のプロセスとも同時に行わないためのロック
+
+    ロック専用のDBファイルの書き込みトランザクションで排他するため、
+    書き出し中も共通のDBへの書き込みは妨げない
+    """
+    root, _ = os.path.splitext(db_url)
+    conn = sqlite3.connect(
+        f"{root}.content.lock", timeout=SNAPSHOT_LOCK_TIMEOUT, isolation_level=None
+    )
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        yield
+    finally:
+        conn.close()
+
+
+# 置き換え先のファイルを他の接続が開いている場合に再試行する回数と間隔(秒)
+REPLACE_RETRIES = 20
+REPLACE_RETRY_INTERVAL = 0.05
+
+
+def replace_file(source, destination):
+    """ファイルを置き換える
+
+    Windowsでは他の接続が開いているファイルを置き換えられないため、
+    閉じられるまで少し待って再試行する
+    """
+    for _ in range(REPLACE_RETRIES - 1):
+        try:
+            os.replace(source, destination)
+            return
+        except PermissionError:
+            time.sleep(REPLACE_RETRY_INTERVAL)
+    os.replace(source, destination)
+
+
+def export_snapshot():
+    """シナリオのテーブルを読み取り専用のスナップショットに書き出す
+
+    スナップショットは書き出すたびに別のファイルとし、参照先のファイル名を
+    記録したファイルだけを置き換える(読み込み中のファイルは置き換えない)
+    """
+    if not app.config["ARGS"].snapshot:
+        return
+    db_url = app.config["ARGS"].database
+    root, ext = os.path.splitext(db_url)
+    with snapshot_lock(db_url):
+        generation = 0
+        previous = current_snapshot(db_url)
+        if previous:
+            stem = previous[: len(previous) - len(ext)]
+            generation = int(stem.rsplit(".", 1)[1]) + 1
+        path = snapshot_path(db_url, generation)
+        if os.path.exists(path):
+            os.remove(path)
+        with db_connection(db_url) as db:
+            db.execute("ATTACH DATABASE ? AS export", (sqlite_uri(path),))
+            db.execute("PRAGMA export.journal_mode = OFF")
+            placeholders = ", ".join("?" * len(CONTENT_TABLES))
+            schema = db.execute(
+                f"""
+                SELECT type, name, sql FROM sqlite_master
+                WHERE tbl_name IN ({placeholders})
+                AND type IN ('table', 'index') AND sql IS NOT NULL
+                ORDER BY type = 'index'
+                """,
+                CONTENT_TABLES,
+            ).fetchall()
+            for row in schema:
+                name = row["name"]
+                db.execute(row["sql"].replace(name, f"export.{name}", 1))
+                if row["type"] == "table":
+                    db.execute(f"INSERT INTO export.{name} SELECT * FROM main.{name}")
+            db.commit()
+            db.execute("DETACH DATABASE export")
+
+        pointer = snapshot_pointer(db_url)
+        with open(f"{pointer}.tmp", "w", encoding="utf-8") as f:
+            f.write(os.path.basename(path))
+        replace_file(f"{pointer}.tmp", pointer)
+
+        # 古いスナップショットを削除する
+        # (読み込み中の接続が残っていて削除できない場合は次回の書き出し時に再度削除する)
+        for old in glob.glob(f"{glob.escape(root)}.content.*{ext}"):
+            number = old[len(root) + len(".content.") : len(old) - len(ext)]
+            if number.isdigit() and os.path.abspath(old) != os.path.abspath(path):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+
+def transact(db_url, route=None):
+    """関数の第1引数にDBの接続を渡してトランザクション内で実行する
+
+    route には関数の引数から接続先のシャードを返す関数を指定する
+    (route を指定した関数ではシナリオをスナップショットから読み込む)
+    """
 
-def transact(db_url):
     def transact(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             try:
-                conn = sqlite3.connect(db_url)
-                conn.row_factory = sqlite3.Row
+                if route:
+                    conn = connect(db_url, route(*args, **kwargs), snapshot=True)
+                else:
+                    conn = connect(db_url)
                 result = func(conn, *args, **kwargs)
                 conn.commit()
-                return result
             except Exception as e:
                 conn.rollback()
                 raise e
             finally:
                 conn.close()
+            run_after_commit(conn)
+            return result
 
         return wrapper
 
@@ -97,10 +431,9 @@ def transact(db_url):
 
 
 @contextmanager
-def db_connection(db_file):
+def db_connection(db_file, shard=None):
     try:
-        conn = sqlite3.connect(db_file)
-        conn.row_factory = sqlite3.Row
+        conn = connect(db_file, shard)
         yield conn
         conn.commit()
     except Exception as e:
@@ -108,6 +441,71 @@ def db_connection(db_file):
         raise e
     finally:
         conn.close()
+    run_after_commit(conn)
+
+
+def play_shards():
+    """プレイ履歴を保存しているシャードの一覧(分割しない場合は共通のDBのみ)"""
+    return range(app.config["ARGS"].shards) or [None]
+
+
+def shard_for(user_id, cohort=None):
+    """ユーザの振り分け先のシャード(コホートが指定されている場合はコホート単位)"""
+    if cohort:
+        return zlib.crc32(cohort.encode("utf-8")) % app.config["ARGS"].shards
+    return user_id % app.config["ARGS"].shards
+
+
+# ユーザIDと振り分け先のシャードの対応(振り分け先は変わらないためキャッシュする)
+user_shards = {}
+
+
+def get_user_shard(user_id):
+    if not app.config["ARGS"].shards or user_id is None:
+        return None
+    if user_id not in user_shards:
+        with db_connection(app.config["ARGS"].database) as db:
+            user = db.execute(
+                "SELECT cohort, shard FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+        if not user:
+            return shard_for(user_id)
+        user_shards[user_id] = (
+            user["shard"]
+            if user["shard"] is not None
+            else shard_for(user_id, user["cohort"])
+        )
+    return user_shards[user_id]
+
+
+def session_shard(*args, **kwargs):
+    """ログイン中のユーザのシャード"""
+    return get_user_shard(session.get("user_id"))
+
+
+def user_shard(user_id, *args, **kwargs):
+    """引数で指定したユーザのシャード"""
+    return get_user_shard(user_id)
+
+
+def query_play_shards(sql, params=()):
+    """全てのシャードで同じクエリを実行して結果をまとめる"""
+    rows = []
+    for shard in play_shards():
+        with db_connection(app.config["ARGS"].database, shard) as db:
+            rows += db.execute(sql, params).fetchall()
+    return rows
+
+
+def assign_shards(db: sqlite3.Connection):
+    """振り分け先が決まっていないユーザのシャードを決める"""
+    if not app.config["ARGS"].shards:
+        return
+    users = db.execute("SELECT id, cohort FROM users WHERE shard IS NULL").fetchall()
+    db.executemany(
+        "UPDATE users SET shard = ? WHERE id = ?",
+        [(shard_for(user["id"], user["cohort"]), user["id"]) for user in users],
+    )
 
 
 def login_required(f):
@@ -130,8 +528,159 @@ def admin_required(f):
     return decorated_function
 
 
+def request_slot():
+    """リクエストで指定されたセーブスロットの番号"""
+    slot = request.args.get("slot", type=int, default=0)
+    if not 0 <= slot < app.config["SAVE_SLOTS"]:
+        abort(404)
+    return slot
+
+
+def load_save_slots(db: sqlite3.Connection, user_id, scenarios):
+    """シナリオごとにセーブスロットの状態を並べる(未使用のスロットは None)"""
+    slot_count = app.config["SAVE_SLOTS"]
+    slots = {}
+    for row in db.execute(
+        """
+        SELECT
+            scenario_id, slot, current_scene_id, is_completed, updated_at,
+            LENGTH(path) / 4 AS selection_count
+        FROM play_history
+        WHERE user_id = ? AND slot < ?
+        """,
+        (user_id, slot_count),
+    ):
+        slots.setdefault(row["scenario_id"], [None] * slot_count)[row["slot"]] = row
+    return [
+        {**scenario, "slots": slots.get(scenario["id"], [None] * slot_count)}
+        for scenario in scenarios
+    ]
+
+
+def add_column_if_not_exists(db: sqlite3.Connection, table, column, definition):
+    columns = [row["name"] for row in db.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# 1回の整理でファイルから解放するページ数の上限(残りは次回の整理で解放する)
+VACUUM_PAGES = 1000
+
+
+def release_free_pages(db: sqlite3.Connection, limit=VACUUM_PAGES):
+    """削除で空いたページをファイルから解放する
+
+    sqlite3モジュールは結果を返さないPRAGMAを1ステップしか実行せず、
+    incremental_vacuum が1ページしか解放しないため、1ページずつ実行する
+    """
+    pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+    for _ in range(pages if limit is None else min(pages, limit)):
+        db.execute("PRAGMA incremental_vacuum(1)")
+
+
+def configure_db(db: sqlite3.Connection):
+    # 履歴の整理で空いた領域を少しずつ解放できるようにする(既存のDBは一度だけ再構築)
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
+
+    # シナリオ更新中もプレイヤーの読み込みを妨げないようWALモードを使用
+    db.execute("PRAGMA journal_mode=WAL")
+
+
+def create_play_tables(db: sqlite3.Connection):
+    # プレイ履歴テーブル
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS play_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            scenario_id INTEGER NOT NULL,
+            version_id INTEGER,
+            current_scene_id INTEGER NOT NULL,
+            is_completed BOOLEAN NOT NULL DEFAULT 0,
+            seed INTEGER,
+            rng_step INTEGER NOT NULL DEFAULT 0,
+            slot INTEGER NOT NULL DEFAULT 0,
+            path BLOB NOT NULL DEFAULT X'',
+            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (scenario_id) REFERENCES scenarios (id),
+            FOREIGN KEY (version_id) REFERENCES scenario_versions (id)
+        )
+        """
+    )
+    # 更新のたびに経路ごと行を書き直さないよう、更新日時は各UPDATE文で設定する
+    db.execute("DROP TRIGGER IF EXISTS trigger_play_history_updated_at")
+
+    # 旧バージョンのDBに不足しているカラムを追加
+    add_column_if_not_exists(db, "play_history", "version_id", "INTEGER")
+    add_column_if_not_exists(db, "play_history", "seed", "INTEGER")
+    add_column_if_not_exists(
+        db, "play_history", "rng_step", "INTEGER NOT NULL DEFAULT 0"
+    )
+    add_column_if_not_exists(db, "play_history", "slot", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_not_exists(db, "play_history", "path", "BLOB NOT NULL DEFAULT X''")
+    pack_play_paths(db)
+
+    # インデックス
+    db.execute("DROP INDEX IF EXISTS index_play_history_user_id")
+    db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS index_play_history_slot ON play_history (user_id, scenario_id, slot)"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS index_play_history_version_id ON play_history (version_id)"
+    )
+
+
+def pack_play_paths(db: sqlite3.Connection):
+    """旧バージョンの選択履歴とアーカイブをプレイ履歴の path にまとめる"""
+    tables = {
+        row["name"]
+        for row in db.execute(
+            """
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name IN ('selection_history', 'play_archive')
+            """
+        )
+    }
+    if not tables:
+        return
+    paths = {}
+    if "play_archive" in tables:
+        for row in db.execute("SELECT play_history_id, selections FROM play_archive"):
+            paths[row["play_history_id"]] = unpack_ids(row["selections"])
+    if "selection_history" in tables:
+        for row in db.execute(
+            "SELECT play_history_id, selection_id FROM selection_history ORDER BY id"
+        ):
+            paths.setdefault(row["play_history_id"], []).append(row["selection_id"])
+    db.executemany(
+        "UPDATE play_history SET path = ? WHERE id = ?",
+        ((pack_ids(path), play_id) for play_id, path in paths.items()),
+    )
+    for table in tables:
+        db.execute(f"DROP TABLE {table}")
+    # 以前は再プレイのたびに削除していたため重複はないが、念のため最新のみ残す
+    db.execute(
+        """
+        DELETE FROM play_history WHERE id NOT IN
+        (SELECT MAX(id) FROM play_history GROUP BY user_id, scenario_id, slot)
+        """
+    )
+    # 削除したテーブルのページをファイルから解放
+    release_free_pages(db, limit=None)
+
+
 @transact(app.config["ARGS"].database)
 def init_db(db: sqlite3.Connection):
+    # スキーマが最新であれば何もしない
+    if db.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        return
+
+    configure_db(db)
+
     # 管理者テーブル
     db.execute(
         """
@@ -160,6 +709,8 @@ def init_db(db: sqlite3.Connection):
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password TEXT NOT NULL,
+            cohort TEXT,
+            shard INTEGER,
             created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
         )
@@ -181,6 +732,7 @@ def init_db(db: sqlite3.Connection):
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT UNIQUE NOT NULL,
             description TEXT NOT NULL,
+            current_version_id INTEGER,
             created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
         )
@@ -195,19 +747,45 @@ def init_db(db: sqlite3.Connection):
         """
     )
 
+    # シナリオバージョンテーブル
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scenario_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scenario_id INTEGER NOT NULL,
+            is_published BOOLEAN NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat_at REAL,
+            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            FOREIGN KEY (scenario_id) REFERENCES scenarios (id)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trigger_scenario_versions_updated_at AFTER UPDATE ON scenario_versions
+        BEGIN
+            UPDATE scenario_versions SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
+        END
+        """
+    )
+
     # シーンテーブル
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS scenes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             scenario_id INTEGER NOT NULL,
+            version_id INTEGER,
             scene_id INTEGER NOT NULL,
             text TEXT NOT NULL,
             image TEXT,
             is_end BOOLEAN NOT NULL,
             created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
-            FOREIGN KEY (scenario_id) REFERENCES scenarios (id)
+            FOREIGN KEY (scenario_id) REFERENCES scenarios (id),
+            FOREIGN KEY (version_id) REFERENCES scenario_versions (id)
         )
         """
     )
@@ -227,6 +805,7 @@ def init_db(db: sqlite3.Connection):
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             scene_id INTEGER NOT NULL,
             text TEXT NOT NULL,
+            next_table BLOB,
             created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             FOREIGN KEY (scene_id) REFERENCES scenes (id)
@@ -249,6 +828,7 @@ def init_db(db: sqlite3.Connection):
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             selection_id INTEGER NOT NULL,
             next_id INTEGER NOT NULL,
+            weight REAL NOT NULL DEFAULT 1,
             created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
             FOREIGN KEY (selection_id) REFERENCES selections (id)
@@ -257,226 +837,1042 @@ def init_db(db: sqlite3.Connection):
     )
     db.execute(
         """
-        CREATE TRIGGER IF NOT EXISTS trigger_next_scenes_updated_at AFTER UPDATE ON next_scenes
-        BEGIN
-            UPDATE next_scenes SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
-        END
+        CREATE TRIGGER IF NOT EXISTS trigger_next_scenes_updated_at AFTER UPDATE ON next_scenes
+        BEGIN
+            UPDATE next_scenes SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
+        END
+        """
+    )
+
+    # プレイ関連のテーブル(シャード分割時は各シャードにも作成)
+    create_play_tables(db)
+
+    # シーンと選択肢の本文の全文検索用テーブル(rowidはscenesのid)
+    # 日本語は単語の区切りが無いため3文字単位で索引を作成する
+    has_scene_search = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'scene_search'"
+    ).fetchone()
+    db.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS scene_search USING fts5 (
+            scene_text, selection_text, tokenize = 'trigram'
+        )
+        """
+    )
+
+    # シナリオファイル取り込み状況テーブル
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scenario_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT UNIQUE NOT NULL,
+            content_hash TEXT,
+            status TEXT NOT NULL,
+            title TEXT,
+            message TEXT,
+            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trigger_scenario_files_updated_at AFTER UPDATE ON scenario_files
+        BEGIN
+            UPDATE scenario_files SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
+        END
+        """
+    )
+
+    # バックグラウンドジョブテーブル
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            filename TEXT,
+            payload BLOB,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            cancel_requested BOOLEAN NOT NULL DEFAULT 0,
+            result TEXT,
+            message TEXT,
+            finished_at TEXT,
+            owner TEXT,
+            heartbeat_at REAL,
+            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+            updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trigger_jobs_updated_at AFTER UPDATE ON jobs
+        BEGIN
+            UPDATE jobs SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
+        END
+        """
+    )
+
+    # 旧バージョンのDBに不足しているカラムを追加
+    add_column_if_not_exists(db, "scenarios", "current_version_id", "INTEGER")
+    add_column_if_not_exists(db, "scenes", "version_id", "INTEGER")
+    add_column_if_not_exists(db, "users", "cohort", "TEXT")
+    add_column_if_not_exists(db, "users", "shard", "INTEGER")
+    add_column_if_not_exists(db, "selections", "next_table", "BLOB")
+    add_column_if_not_exists(db, "next_scenes", "weight", "REAL NOT NULL DEFAULT 1")
+    add_column_if_not_exists(db, "scenario_versions", "owner", "TEXT")
+    add_column_if_not_exists(db, "scenario_versions", "heartbeat_at", "REAL")
+    add_column_if_not_exists(db, "jobs", "owner", "TEXT")
+    add_column_if_not_exists(db, "jobs", "heartbeat_at", "REAL")
+
+    # バージョン導入前に登録されたシナリオを初期バージョンとして登録
+    legacy_scenarios = db.execute(
+        """
+        SELECT id FROM scenarios
+        WHERE current_version_id IS NULL
+        AND id IN (SELECT scenario_id FROM scenes WHERE version_id IS NULL)
+        """
+    ).fetchall()
+    for scenario in legacy_scenarios:
+        version_id = db.execute(
+            "INSERT INTO scenario_versions (scenario_id, is_published) VALUES (?, 1)",
+            (scenario["id"],),
+        ).lastrowid
+        db.execute(
+            "UPDATE scenes SET version_id = ? WHERE scenario_id = ? AND version_id IS NULL",
+            (version_id, scenario["id"]),
+        )
+        db.execute(
+            "UPDATE play_history SET version_id = ? WHERE scenario_id = ? AND version_id IS NULL",
+            (version_id, scenario["id"]),
+        )
+        db.execute(
+            "UPDATE scenarios SET current_version_id = ? WHERE id = ?",
+            (version_id, scenario["id"]),
+        )
+
+    # 遷移先の重み付け導入前に登録された選択肢のエイリアステーブルを作成
+    targets = {}
+    for row in db.execute(
+        """
+        SELECT ns.selection_id, ns.next_id, ns.weight
+        FROM next_scenes ns
+        JOIN selections s ON ns.selection_id = s.id
+        WHERE s.next_table IS NULL
+        ORDER BY ns.id
+        """
+    ):
+        targets.setdefault(row["selection_id"], []).append(
+            (row["next_id"], row["weight"])
+        )
+    db.executemany(
+        "UPDATE selections SET next_table = ? WHERE id = ?",
+        [
+            (build_alias_table(selection_targets), selection_id)
+            for selection_id, selection_targets in targets.items()
+        ],
+    )
+
+    # 全文検索の導入前に登録されたシーンを索引に追加
+    if not has_scene_search:
+        db.execute(
+            """
+            INSERT INTO scene_search (rowid, scene_text, selection_text)
+            SELECT
+                s.id,
+                s.text,
+                (SELECT GROUP_CONCAT(text, CHAR(10)) FROM selections WHERE scene_id = s.id)
+            FROM scenes s
+            """
+        )
+
+    # インデックス
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS index_scenes_version_id ON scenes (version_id, scene_id)"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS index_selections_scene_id ON selections (scene_id)"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS index_next_scenes_selection_id ON next_scenes (selection_id)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS index_jobs_status ON jobs (status, id)")
+
+    db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def init_shards():
+    shards = app.config["ARGS"].shards
+    with db_connection(app.config["ARGS"].database) as db:
+        # 振り分け済みのユーザがいる場合はシャード数を変更できない
+        max_shard = db.execute("SELECT MAX(shard) FROM users").fetchone()[0]
+        if max_shard is not None and max_shard >= shards:
+            raise ValueError(
+                f"Users are already assigned to {max_shard + 1} or more shards."
+            )
+        # シャード分割を有効にする前に登録されたユーザの振り分け先を決める
+        assign_shards(db)
+
+    for shard in range(shards):
+        with db_connection(shard_path(app.config["ARGS"].database, shard)) as db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                configure_db(db)
+                create_play_tables(db)
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            migrate_play_history(db, shard)
+
+
+def migrate_play_history(db: sqlite3.Connection, shard):
+    """共通のDBに残っているプレイ履歴をシャードに移す
+
+    WALモードでは複数のDBファイルにまたがるトランザクションが不可分でないため、
+    シャードへの追加だけが反映されて中断された場合は、次回の起動時に
+    追加済みの行を無視して共通のDBから削除する
+    """
+    db.execute(
+        "ATTACH DATABASE ? AS content",
+        (app.config["ARGS"].database,),
+    )
+    play_ids = "SELECT id FROM temp.shard_plays"
+    db.execute(
+        """
+        CREATE TEMP TABLE shard_plays AS
+        SELECT ph.id FROM content.play_history ph
+        JOIN content.users u ON ph.user_id = u.id
+        WHERE u.shard = ?
+        """,
+        (shard,),
+    )
+    db.execute(
+        f"""
+        INSERT OR IGNORE INTO main.play_history (
+            id, user_id, scenario_id, version_id, current_scene_id,
+            is_completed, seed, rng_step, slot, path, created_at, updated_at
+        )
+        SELECT
+            id, user_id, scenario_id, version_id, current_scene_id,
+            is_completed, seed, rng_step, slot, path, created_at, updated_at
+        FROM content.play_history WHERE id IN ({play_ids})
+        """
+    )
+    db.execute(f"DELETE FROM content.play_history WHERE id IN ({play_ids})")
+    db.execute("DROP TABLE temp.shard_plays")
+
+
+def read_source(source):
+    """ファイルパス、バイト列、ストリームのいずれかから内容をバイト列で取得する"""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if hasattr(source, "read"):
+        return source.read()
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def read_csv(source):
+    return csv.DictReader(io.StringIO(read_source(source).decode("utf-8-sig")))
+
+
+@transact(app.config["ARGS"].database)
+def admin_register_from_csv(db: sqlite3.Connection, csv_file):
+    for admin in read_csv(csv_file):
+        db.execute(
+            """
+            INSERT INTO admins (username, password) VALUES (?, ?)
+            ON CONFLICT (username)
+            DO UPDATE SET password = excluded.password
+            """,
+            (admin["username"], hash_password(admin["password"])),
+        )
+
+
+@transact(app.config["ARGS"].database)
+def register_from_csv(db: sqlite3.Connection, csv_file, progress=None):
+    rows = list(read_csv(csv_file))
+
+    # パスワードのハッシュ化に時間がかかるため、先に済ませてから書き込みを行う
+    users = []
+    for i, user in enumerate(rows, 1):
+        users.append(
+            (
+                user["username"],
+                hash_password(user["password"]),
+                user.get("cohort") or None,
+            )
+        )
+        if progress:
+            progress(i, len(rows))
+
+    # コホートは登録時のみ設定する(振り分け先のシャードが変わらないように)
+    db.executemany(
+        """
+        INSERT INTO users (username, password, cohort) VALUES (?, ?, ?)
+        ON CONFLICT (username)
+        DO UPDATE SET password = excluded.password
+        """,
+        users,
+    )
+    assign_shards(db)
+    return len(users)
+
+
+@contextmanager
+def load_scenario(source):
+    """シナリオを読み込む
+
+    コンパイル済みの形式の場合はコンパイル時に検証済みのため、
+    チェックサムの確認のみ行いメモリマップで読み込む
+    """
+    if hasattr(source, "read"):
+        source = source.read()
+    if is_compiled(source):
+        with CompiledScenario(source) as scenario:
+            yield scenario.as_dict()
+    else:
+        scenario_data = json.loads(read_source(source))
+        validate_json(scenario_data)
+        yield scenario_data
+
+
+def delete_stale_versions(
+    db: sqlite3.Connection, scenario_id=None, include_unpublished=False
+):
+    """現在公開中でなく、どのプレイからも参照されていないシナリオバージョンを削除する
+
+    include_unpublished を指定した場合は、取り込みが中断された未公開のバージョン
+    (生存の記録が途絶えたもの)も削除する
+    """
+    stale_versions = db.execute(
+        """
+        SELECT v.id
+        FROM scenario_versions v
+        JOIN scenarios s ON v.scenario_id = s.id
+        WHERE v.id != IFNULL(s.current_version_id, 0)
+        AND (
+            v.is_published = 1
+            OR (? AND (v.heartbeat_at IS NULL OR v.heartbeat_at < ?))
+        )
+        AND (? IS NULL OR v.scenario_id = ?)
+        AND NOT EXISTS (SELECT 1 FROM play_history ph WHERE ph.version_id = v.id)
+        """,
+        (
+            include_unpublished,
+            time.time() - LEASE_TIMEOUT,
+            scenario_id,
+            scenario_id,
+        ),
+    ).fetchall()
+    if app.config["ARGS"].shards:
+        # シャードに保存されたプレイから参照されているバージョンは残す
+        referenced = {
+            row["version_id"]
+            for row in query_play_shards(
+                "SELECT DISTINCT version_id FROM play_history"
+            )
+        }
+        stale_versions = [
+            version for version in stale_versions if version["id"] not in referenced
+        ]
+    for version in stale_versions:
+        delete_version(db, version["id"])
+    if stale_versions:
+        release_free_pages(db)
+    return len(stale_versions)
+
+
+def delete_version(db: sqlite3.Connection, version_id):
+    db.execute(
+        """
+        DELETE FROM scene_search WHERE rowid IN
+        (SELECT id FROM scenes WHERE version_id = ?)
+        """,
+        (version_id,),
+    )
+    db.execute(
+        """
+        DELETE FROM next_scenes WHERE selection_id IN
+        (
+            SELECT sel.id
+            FROM selections sel
+            JOIN scenes sc ON sel.scene_id = sc.id
+            WHERE sc.version_id = ?
+        )
+        """,
+        (version_id,),
+    )
+    db.execute(
+        """
+        DELETE FROM selections WHERE scene_id IN
+        (SELECT id FROM scenes WHERE version_id = ?)
+        """,
+        (version_id,),
+    )
+    db.execute("DELETE FROM scenes WHERE version_id = ?", (version_id,))
+    db.execute("DELETE FROM scenario_versions WHERE id = ?", (version_id,))
+    scenario_cache.evict(version_id)
+
+
+@transact(app.config["ARGS"].database)
+def cleanup_scenario_versions(db: sqlite3.Connection):
+    # 起動時は中断された取り込みの残骸も削除する
+    # (他のプロセスが取り込み中のバージョンは生存が記録されているため残る)
+    return delete_stale_versions(db, include_unpublished=True)
+
+
+@transact(app.config["ARGS"].database)
+def collect_scenario_versions(db: sqlite3.Connection, scenario_id):
+    return delete_stale_versions(db, scenario_id)
+
+
+def import_scenario(scenario_json, progress=None):
+    with load_scenario(scenario_json) as scenario_data:
+        title, scenario_id = store_scenario(scenario_data, progress)
+    # プレイヤーが旧スナップショットから削除予定のバージョンを読み込まないよう、
+    # スナップショットを切り替えてから旧バージョンを削除する
+    export_snapshot()
+    # プレイ中のユーザがいなくなった旧バージョンを削除
+    collect_scenario_versions(scenario_id)
+    return title
+
+
+@transact(app.config["ARGS"].database)
+def store_scenario(db: sqlite3.Connection, scenario_data, progress=None):
+    cursor = db.cursor()
+
+    # シナリオの登録(既存のシナリオは公開時に説明文を更新する)
+    cursor.execute(
+        "INSERT INTO scenarios (title, description) VALUES (?, ?) ON CONFLICT (title) DO NOTHING",
+        (scenario_data["title"], scenario_data["description"]),
+    )
+    scenario_id = cursor.execute(
+        "SELECT id FROM scenarios WHERE title = ?", (scenario_data["title"],)
+    ).fetchone()["id"]
+
+    # 新しいバージョンを未公開の状態で作成
+    version_id = cursor.execute(
+        "INSERT INTO scenario_versions (scenario_id, owner, heartbeat_at) VALUES (?, ?, ?)",
+        (scenario_id, PROCESS_ID, time.time()),
+    ).lastrowid
+    db.commit()
+
+    try:
+        # シーンと選択肢の登録
+        # 未公開のバージョンはプレイヤーから参照されないため、
+        # 一定件数ごとにコミットして書き込みロックを手放す
+        for i, scene in enumerate(scenario_data["scenes"], 1):
+            cursor.execute(
+                """
+                INSERT INTO scenes (scenario_id, version_id, scene_id, text, image, is_end)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    scenario_id,
+                    version_id,
+                    scene["id"],
+                    scene["text"],
+                    scene.get("image"),
+                    scene.get("end", False),
+                ),
+            )
+            scene_id = cursor.lastrowid
+
+            cursor.execute(
+                """
+                INSERT INTO scene_search (rowid, scene_text, selection_text)
+                VALUES (?, ?, ?)
+                """,
+                (
+                    scene_id,
+                    scene["text"],
+                    "\n".join(selection["text"] for selection in scene["selection"]),
+                ),
+            )
+
+            for selection in scene["selection"]:
+                # 遷移先はプレイ時に定数時間で選べるようエイリアステーブルにしておく
+                targets = next_targets(selection["nextId"])
+                cursor.execute(
+                    "INSERT INTO selections (scene_id, text, next_table) VALUES (?, ?, ?)",
+                    (scene_id, selection["text"], build_alias_table(targets)),
+                )
+                selection_id = cursor.lastrowid
+                cursor.executemany(
+                    """
+                    INSERT INTO next_scenes (selection_id, next_id, weight)
+                    VALUES (?, ?, ?)
+                    """,
+                    [(selection_id, next_id, weight) for next_id, weight in targets],
+                )
+            if i % IMPORT_BATCH_SIZE == 0:
+                cursor.execute(
+                    "UPDATE scenario_versions SET heartbeat_at = ? WHERE id = ?",
+                    (time.time(), version_id),
+                )
+                db.commit()
+                if progress:
+                    progress(i, len(scenario_data["scenes"]))
+
+        # 参照先を切り替えて新しいバージョンを公開
+        cursor.execute(
+            "UPDATE scenario_versions SET is_published = 1 WHERE id = ?",
+            (version_id,),
+        )
+        cursor.execute(
+            "UPDATE scenarios SET description = ?, current_version_id = ? WHERE id = ?",
+            (scenario_data["description"], version_id, scenario_id),
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        delete_version(db, version_id)
+        db.commit()
+        raise e
+
+    cursor.close()
+
+    return scenario_data["title"], scenario_id
+
+
+@transact(app.config["ARGS"].database)
+def get_scenario_file_hash(db: sqlite3.Connection, path):
+    scenario_file = db.execute(
+        "SELECT content_hash FROM scenario_files WHERE path = ?", (path,)
+    ).fetchone()
+    return scenario_file["content_hash"] if scenario_file else None
+
+
+@transact(app.config["ARGS"].database)
+def update_scenario_file(
+    db: sqlite3.Connection, path, status, content_hash=None, title=None, message=None
+):
+    db.execute(
+        """
+        INSERT INTO scenario_files (path, status, content_hash, title, message)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (path)
+        DO UPDATE SET
+            status = excluded.status,
+            content_hash = IFNULL(excluded.content_hash, content_hash),
+            title = IFNULL(excluded.title, title),
+            message = excluded.message
+        """,
+        (path, status, content_hash, title, message),
+    )
+
+
+@transact(app.config["ARGS"].database)
+def delete_scenario_file(db: sqlite3.Connection, path):
+    db.execute("DELETE FROM scenario_files WHERE path = ?", (path,))
+
+
+def sync_scenario_file(path):
+    """内容が前回の取り込み時から変わっている場合のみシナリオを取り込む"""
+    try:
+        with open(path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return
+    if get_scenario_file_hash(path) == content_hash:
+        return
+
+    update_scenario_file(path, "importing")
+    try:
+        title = import_scenario(path)
+        update_scenario_file(path, "imported", content_hash, title)
+        print(f"Imported scenario: {title}")
+    except Exception as e:
+        # 同じ内容のファイルは再度取り込まない
+        update_scenario_file(path, "failed", content_hash, message=str(e))
+        print(f"Import scenario failed: {path}")
+
+
+# inotifyのイベント種別
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+
+def open_inotify(directory):
+    """inotifyが使用できる環境であればフォルダを監視するファイルディスクリプタを返す"""
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+        if fd < 0:
+            return None
+        mask = (
+            IN_MODIFY
+            | IN_CLOSE_WRITE
+            | IN_MOVED_FROM
+            | IN_MOVED_TO
+            | IN_CREATE
+            | IN_DELETE
+        )
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def wait_for_changes(fd, timeout):
+    if fd is None:
+        time.sleep(timeout)
+        return
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if readable:
+        # イベントの内容は使わずフォルダを再走査する
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def watch_scenario_folder(directory):
+    """フォルダ内のシナリオjsonの変更を監視し、書き込みが落ち着いたファイルを取り込む"""
+    fd = open_inotify(directory)
+    if fd is None:
+        print(f"Watching scenarios (polling): {directory}")
+    else:
+        print(f"Watching scenarios (inotify): {directory}")
+
+    interval = app.config["WATCH_INTERVAL"]
+    debounce = app.config["WATCH_DEBOUNCE"]
+    watched = {}
+    while True:
+        now = time.monotonic()
+        current = {}
+        try:
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.endswith((".json", EXTENSION)):
+                    stat = entry.stat()
+                    current[os.path.abspath(entry.path)] = (
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                    )
+        except OSError:
+            pass
+
+        for path in watched.keys() - current.keys():
+            del watched[path]
+            delete_scenario_file(path)
+
+        pending = False
+        for path, signature in current.items():
+            state = watched.get(path)
+            if state is None or state["signature"] != signature:
+                watched[path] = {"signature": signature, "changed_at": now}
+                pending = True
+            elif "synced" not in state:
+                if now - state["changed_at"] < debounce:
+                    pending = True
+                    continue
+                try:
+                    sync_scenario_file(path)
+                except Exception as e:
+                    print(f"Watch scenario failed: {path} ({e})")
+                state["synced"] = True
+
+        wait_for_changes(fd, debounce if pending else interval)
+
+
+def start_scenario_watcher(directory):
+    thread = threading.Thread(
+        target=watch_scenario_folder, args=(directory,), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def new_seed():
+    """プレイごとの乱数のシード"""
+    return random.getrandbits(63)
+
+
+def pack_ids(ids):
+    """IDの列を4バイトの符号なし整数(リトルエンディアン)の配列に詰める"""
+    packed = array.array("I", ids)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_ids(blob):
+    ids = array.array("I")
+    ids.frombytes(blob)
+    if sys.byteorder == "big":
+        ids.byteswap()
+    return ids.tolist()
+
+
+# バックグラウンドジョブ
+JOB_HANDLERS = {
+    "import_scenario": import_scenario,
+    "register_from_csv": register_from_csv,
+}
+# ジョブの待機中に他プロセスからの登録を確認する間隔(秒)
+JOB_POLL_INTERVAL = 5
+# 進捗をDBに書き込む最小間隔(秒)
+JOB_PROGRESS_INTERVAL = 0.5
+# DBがロックされている等でジョブの取得や結果の記録に失敗した場合の再試行の間隔(秒)と回数
+JOB_RETRY_INTERVAL = 1
+JOB_FINISH_RETRIES = 8
+
+job_event = threading.Event()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@transact(app.config["ARGS"].database)
+def enqueue_job(db: sqlite3.Connection, kind, filename, payload):
+    """時間のかかる処理をバックグラウンドで実行するジョブとして登録する"""
+    job_id = db.execute(
+        "INSERT INTO jobs (kind, filename, payload) VALUES (?, ?, ?)",
+        (kind, filename, payload),
+    ).lastrowid
+    db.commit()
+    job_event.set()
+    return job_id
+
+
+@transact(app.config["ARGS"].database)
+def claim_job(db: sqlite3.Connection):
+    jobs = db.execute(
+        """
+        UPDATE jobs SET status = 'running', owner = ?, heartbeat_at = ?
+        WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+        AND status = 'queued'
+        RETURNING id, kind, payload
+        """,
+        (PROCESS_ID, time.time()),
+    ).fetchall()
+    return jobs[0] if jobs else None
+
+
+@transact(app.config["ARGS"].database)
+def update_job_progress(db: sqlite3.Connection, job_id, progress, total):
+    job = db.execute(
         """
-    )
+        UPDATE jobs SET progress = ?, total = ?
+        WHERE id = ? AND owner = ?
+        RETURNING cancel_requested
+        """,
+        (progress, total, job_id, PROCESS_ID),
+    ).fetchall()
+    # 他のプロセスに引き継がれたジョブは中断する
+    return not job or bool(job[0]["cancel_requested"])
 
-    # プレイ履歴テーブル
+
+@transact(app.config["ARGS"].database)
+def finish_job(db: sqlite3.Connection, job_id, status, result=None, message=None):
     db.execute(
         """
-        CREATE TABLE IF NOT EXISTS play_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            scenario_id INTEGER NOT NULL,
-            current_scene_id INTEGER NOT NULL,
-            is_completed BOOLEAN NOT NULL DEFAULT 0,
-            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
-            updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (scenario_id) REFERENCES scenarios (id)
-        )
-        """
+        UPDATE jobs
+        SET status = ?, result = ?, message = ?, payload = NULL,
+            finished_at = DATETIME('now', 'localtime')
+        WHERE id = ? AND owner = ?
+        """,
+        (status, json.dumps(result, ensure_ascii=False), message, job_id, PROCESS_ID),
     )
+    # 保持期間を過ぎたジョブを削除
     db.execute(
-        """
-        CREATE TRIGGER IF NOT EXISTS trigger_play_history_updated_at AFTER UPDATE ON play_history
-        BEGIN
-            UPDATE play_history SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
-        END
-        """
+        "DELETE FROM jobs WHERE finished_at < DATETIME('now', 'localtime', ?)",
+        (f"{-app.config['JOB_RETENTION_DAYS']} days",),
     )
+    # 削除したジョブと結果の記録で空になったペイロードのページを解放
+    release_free_pages(db)
+
 
-    # 選択履歴テーブル
+@transact(app.config["ARGS"].database)
+def cancel_job(db: sqlite3.Connection, job_id):
+    # 待機中のジョブはその場で取り消し、実行中のジョブは次の進捗報告時に中断する
     db.execute(
         """
-        CREATE TABLE IF NOT EXISTS selection_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            play_history_id INTEGER NOT NULL,
-            scene_id INTEGER NOT NULL,
-            selection_id INTEGER NOT NULL,
-            created_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
-            updated_at TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
-            FOREIGN KEY (play_history_id) REFERENCES play_history (id),
-            FOREIGN KEY (scene_id) REFERENCES scenes (id),
-            FOREIGN KEY (selection_id) REFERENCES selections (id)
-        )
-        """
+        UPDATE jobs
+        SET status = 'cancelled', payload = NULL, finished_at = DATETIME('now', 'localtime')
+        WHERE id = ? AND status = 'queued'
+        """,
+        (job_id,),
     )
     db.execute(
-        """
-        CREATE TRIGGER IF NOT EXISTS trigger_selection_history_updated_at AFTER UPDATE ON selection_history
-        BEGIN
-            UPDATE selection_history SET updated_at = DATETIME('now', 'localtime') WHERE rowid == NEW.rowid;
-        END
-        """
+        "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'",
+        (job_id,),
     )
 
 
 @transact(app.config["ARGS"].database)
-def admin_register_from_csv(db: sqlite3.Connection, csv_file: str):
-    with open(csv_file, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for admin in reader:
-            db.execute(
-                """
-                INSERT INTO admins (username, password) VALUES (?, ?)
-                ON CONFLICT (username)
-                DO UPDATE SET password = excluded.password
-                """,
-                (admin["username"], generate_password_hash(admin["password"])),
-            )
+def requeue_interrupted_jobs(db: sqlite3.Connection):
+    # 実行していたプロセスが停止して生存の記録が途絶えたジョブを再実行する
+    return db.execute(
+        """
+        UPDATE jobs SET status = 'queued', progress = 0, owner = NULL
+        WHERE status = 'running'
+        AND (heartbeat_at IS NULL OR heartbeat_at < ?)
+        """,
+        (time.time() - LEASE_TIMEOUT,),
+    ).rowcount
 
 
 @transact(app.config["ARGS"].database)
-def register_from_csv(db: sqlite3.Connection, csv_file: str):
-    with open(csv_file, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for user in reader:
-            db.execute(
-                """
-                INSERT INTO users (username, password) VALUES (?, ?)
-                ON CONFLICT (username)
-                DO UPDATE SET password = excluded.password
-                """,
-                (user["username"], generate_password_hash(user["password"])),
-            )
+def record_heartbeat(db: sqlite3.Connection):
+    db.execute(
+        "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = 'running'",
+        (time.time(), PROCESS_ID),
+    )
 
 
-def validate_json(data):
-    schema = {
-        "type": "object",
-        "properties": {
-            "title": {"type": "string"},
-            "description": {"type": "string"},
-            "scenes": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "id": {"type": "integer"},
-                        "text": {"type": "string"},
-                        "image": {"type": "string"},
-                        "end": {"type": "boolean"},
-                        "selection": {
-                            "type": "array",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "nextId": {
-                                        "oneOf": [
-                                            {"type": "integer"},
-                                            {
-                                                "type": "array",
-                                                "items": {"type": "integer"},
-                                                "minItems": 1,
-                                            },
-                                        ]
-                                    },
-                                    "text": {"type": "string"},
-                                },
-                                "required": ["text", "nextId"],
-                            },
-                            "minItems": 0,
-                        },
-                    },
-                    "required": ["id", "text", "selection"],
-                    "if": {"properties": {"end": {"const": False}}},
-                    "then": {"properties": {"selection": {"minItems": 1}}},
-                },
-            },
-        },
-        "required": ["title", "description", "scenes"],
-    }
-    try:
-        validate(instance=data, schema=schema)
-    except ValidationError as e:
-        print(f"ValidationError: {e.message}")
-        raise e
-    except SchemaError as e:
-        print(f"SchemaError: {e.message}")
-        raise e
+def run_heartbeat():
+    while True:
+        try:
+            record_heartbeat()
+            if requeue_interrupted_jobs():
+                job_event.set()
+        except sqlite3.Error:
+            pass
+        time.sleep(HEARTBEAT_INTERVAL)
 
 
-@transact(app.config["ARGS"].database)
-def import_scenario(db: sqlite3.Connection, scenario_json):
-    with open(scenario_json, "r", encoding="utf-8") as f:
-        scenario_data = json.load(f)
-    validate_json(scenario_data)
-    cursor = db.cursor()
+def job_to_dict(job):
+    job = dict(job)
+    job.pop("payload", None)
+    if job.get("result") is not None:
+        job["result"] = json.loads(job["result"])
+    return job
 
-    # 既存のシーンと選択肢を削除
-    existing_scenario = cursor.execute(
-        "SELECT id FROM scenarios WHERE title = ?", (scenario_data["title"],)
+
+@transact(app.config["ARGS"].database)
+def get_job(db: sqlite3.Connection, job_id):
+    job = db.execute(
+        "SELECT * FROM jobs WHERE id = ?",
+        (job_id,),
     ).fetchone()
-    if existing_scenario:
-        cursor.execute(
-            """
-            DELETE FROM next_scenes WHERE selection_id IN
-            (
-                SELECT sel.id
-                FROM selections sel
-                JOIN scenes sc ON sel.scene_id = sc.id
-                WHERE sc.scenario_id = ?
-            )
-            """,
-            (existing_scenario["id"],),
-        )
-        cursor.execute(
-            """
-            DELETE FROM selections WHERE scene_id IN
-            (SELECT id FROM scenes WHERE scenario_id = ?)
-            """,
-            (existing_scenario["id"],),
-        )
-        cursor.execute(
-            "DELETE FROM scenes WHERE scenario_id = ?", (existing_scenario["id"],)
-        )
+    return job_to_dict(job) if job else None
 
-    # シナリオの登録
-    scenario_id = cursor.execute(
-        "INSERT OR REPLACE INTO scenarios (title, description) VALUES (?, ?) RETURNING id",
-        (scenario_data["title"], scenario_data["description"]),
-    ).fetchone()["id"]
 
-    # シーンと選択肢の登録
-    for scene in scenario_data["scenes"]:
-        cursor.execute(
-            "INSERT INTO scenes (scenario_id, scene_id, text, image, is_end) VALUES (?, ?, ?, ?, ?)",
-            (
-                scenario_id,
-                scene["id"],
-                scene["text"],
-                scene.get("image"),
-                scene.get("end", False),
-            ),
-        )
-        scene_id = cursor.lastrowid
+@transact(app.config["ARGS"].database)
+def list_jobs(db: sqlite3.Connection, kind, limit=20):
+    jobs = db.execute(
+        "SELECT * FROM jobs WHERE kind = ? ORDER BY id DESC LIMIT ?",
+        (kind, limit),
+    ).fetchall()
+    return [job_to_dict(job) for job in jobs]
 
-        for selection in scene["selection"]:
-            next_ids = selection["nextId"]
-            if isinstance(selection["nextId"], int):
-                next_ids = [next_ids]
 
-            cursor.execute(
-                "INSERT INTO selections (scene_id, text) VALUES (?, ?)",
-                (scene_id, selection["text"]),
-            )
-            selection_id = cursor.lastrowid
-            for next_id in next_ids:
-                cursor.execute(
-                    "INSERT INTO next_scenes (selection_id, next_id) VALUES (?, ?)",
-                    (selection_id, next_id),
-                )
-    cursor.close()
+def job_progress(job_id):
+    last_update = 0
 
-    return scenario_data["title"]
+    def progress(done, total):
+        nonlocal last_update
+        now = time.monotonic()
+        if done < total and now - last_update < JOB_PROGRESS_INTERVAL:
+            return
+        last_update = now
+        if update_job_progress(job_id, done, total):
+            raise JobCancelled()
 
+    return progress
 
-@transact(app.config["ARGS"].database)
-def get_review(db: sqlite3.Connection, user_id, scenario_id):
+
+def complete_job(job_id, status, result=None, message=None):
+    """ジョブの結果を記録する
+
+    DBがロックされている等で記録できない場合は間隔を広げながら再試行する
+    """
+    interval = JOB_RETRY_INTERVAL
+    for attempt in range(JOB_FINISH_RETRIES):
+        try:
+            finish_job(job_id, status, result, message)
+            return
+        except sqlite3.Error as e:
+            print(f"Finish job failed: {job_id} ({e})")
+            time.sleep(interval)
+            interval = min(interval * 2, HEARTBEAT_INTERVAL)
+    print(f"Finish job gave up: {job_id} ({status})")
+
+
+def run_job_worker():
+    while True:
+        try:
+            job = claim_job()
+        except sqlite3.Error as e:
+            # 取得に失敗してもワーカーを止めず、間隔を空けて再試行する
+            print(f"Claim job failed: {e}")
+            time.sleep(JOB_RETRY_INTERVAL)
+            continue
+        if job is None:
+            job_event.wait(JOB_POLL_INTERVAL)
+            job_event.clear()
+            continue
+        try:
+            result = JOB_HANDLERS[job["kind"]](
+                job["payload"], progress=job_progress(job["id"])
+            )
+            complete_job(job["id"], "done", result)
+        except JobCancelled:
+            complete_job(job["id"], "cancelled")
+        except Exception as e:
+            complete_job(job["id"], "failed", message=str(e))
+
+
+def start_job_workers():
+    # 生存の記録と、停止した他のプロセスのジョブの再実行を定期的に行う
+    threading.Thread(target=run_heartbeat, daemon=True).start()
+    for _ in range(app.config["JOB_WORKERS"]):
+        threading.Thread(target=run_job_worker, daemon=True).start()
+    job_event.set()
+
+
+# 選択肢の情報を保持しておくシナリオバージョンの数
+SCENARIO_CACHE_SIZE = 16
+
+
+class ScenarioCache:
+    """シナリオバージョンごとの選択肢の情報
+
+    バージョンの内容は取り込み後に変更されないため、一度読み込めば
+    バージョンが削除されるまで使い回せる
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.versions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def selections(self, db: sqlite3.Connection, version_id):
+        """選択肢IDから選択肢とそのシーンの情報を引ける辞書を返す"""
+        with self.lock:
+            if version_id in self.versions:
+                self.versions.move_to_end(version_id)
+                return self.versions[version_id]
+        selections = {
+            row["id"]: dict(row)
+            for row in db.execute(
+                """
+                SELECT sel.id, s.scene_id, s.text as scene_text, s.image, sel.text as selection_text
+                FROM scenes s
+                JOIN selections sel ON sel.scene_id = s.id
+                WHERE s.version_id = ?
+                """,
+                (version_id,),
+            )
+        }
+        with self.lock:
+            self.versions[version_id] = selections
+            if len(self.versions) > self.size:
+                self.versions.popitem(last=False)
+        return selections
+
+    def evict(self, version_id):
+        with self.lock:
+            self.versions.pop(version_id, None)
+
+
+scenario_cache = ScenarioCache(SCENARIO_CACHE_SIZE)
+
+
+class EventSubscription:
+    """購読者ごとのイベントバッファ
+
+    同じプレイヤー・シナリオのイベントは最新のものだけを残し、
+    上限を超えた場合は古いものから破棄する
+    """
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.events = OrderedDict()
+        self.dropped = False
+        self.condition = threading.Condition()
+
+    def put(self, key, event):
+        with self.condition:
+            self.events.pop(key, None)
+            self.events[key] = event
+            if len(self.events) > self.buffer_size:
+                self.events.popitem(last=False)
+                self.dropped = True
+            self.condition.notify()
+
+    def get(self, timeout):
+        """溜まっているイベントと、取りこぼしがあったかどうかを返す"""
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events.values())
+            dropped = self.dropped
+            self.events.clear()
+            self.dropped = False
+            return events, dropped
+
+
+class EventBroker:
+    """プレイ状況のイベントをプロセス内の購読者に配信する"""
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = EventSubscription(self.buffer_size)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, type, user_id, scenario_id, **data):
+        if not self.subscriptions:
+            return
+        event = {
+            "type": type,
+            "user_id": user_id,
+            "scenario_id": scenario_id,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            **data,
+        }
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put((user_id, scenario_id), event)
+
+
+event_broker = EventBroker(app.config["LIVE_BUFFER_SIZE"])
+# イベントが無い場合に接続維持のコメントを送る間隔(秒)
+LIVE_KEEPALIVE_INTERVAL = 15
+# ダッシュボードを開いた時に表示するプレイ数
+LIVE_SNAPSHOT_SIZE = 500
+
+
+# バックログの1ページあたりの表示件数
+REVIEW_PAGE_SIZE = 50
+
+
+@transact(app.config["ARGS"].database, route=user_shard)
+def get_review(
+    db: sqlite3.Connection,
+    user_id,
+    scenario_id,
+    slot=0,
+    start=0,
+    limit=REVIEW_PAGE_SIZE,
+    compact=False,
+):
+    """選択履歴を start 件目から1ページ分取得する"""
     # シナリオ情報を取得
     scenario = db.execute(
         "SELECT * FROM scenarios WHERE id = ?",
@@ -487,34 +1883,174 @@ def get_review(db: sqlite3.Connection, user_id, scenario_id):
     play_history = db.execute(
         """
         SELECT * FROM play_history
-        WHERE user_id = ? AND scenario_id = ?
+        WHERE user_id = ? AND scenario_id = ? AND slot = ?
         """,
-        (user_id, scenario_id),
+        (user_id, scenario_id, slot),
     ).fetchone()
+    if not play_history:
+        return scenario, [], None, None
+
+    # 選択した選択肢IDの列をプレイ中のバージョンの選択肢に展開する
+    path = unpack_ids(play_history["path"])
+    selections = scenario_cache.selections(db, play_history["version_id"])
+    selection_history = [
+        dict(selections[id])
+        for id in path[start : start + limit]
+        if id in selections
+    ]
 
-    # 選択履歴を取得
-    selection_history = db.execute(
-        """
-        SELECT s.scene_id, s.text as scene_text, s.image, sel.text as selection_text
-        FROM selection_history sh
-        JOIN scenes s ON sh.scene_id = s.id
-        JOIN selections sel ON sh.selection_id = sel.id
-        WHERE sh.play_history_id = ?
-        ORDER BY sh.created_at, sh.id
-        """,
-        (play_history["id"],),
-    ).fetchall()
+    # 既に表示したシーンへの再訪は折りたたんで表示する
+    if compact:
+        seen = {selections[id]["scene_id"] for id in path[:start] if id in selections}
+        for selection in selection_history:
+            selection["repeated"] = selection["scene_id"] in seen
+            seen.add(selection["scene_id"])
+
+    next_page = None
+    if start + limit < len(path):
+        next_page = {"start": start + limit}
 
     ending = db.execute(
         """
         SELECT s.*, sc.title as scenario_title
         FROM scenes s
         JOIN scenarios sc ON s.scenario_id = sc.id
-        WHERE s.scenario_id = ? AND s.scene_id = ?
+        WHERE s.version_id = ? AND s.scene_id = ?
         """,
-        (scenario_id, play_history["current_scene_id"]),
+        (play_history["version_id"], play_history["current_scene_id"]),
     ).fetchone()
-    return scenario, selection_history, ending
+    return scenario, selection_history, ending, next_page
+
+
+def render_review(user_id, scenario_id, **context):
+    compact = request.args.get("compact", type=int, default=0)
+    slot = request_slot()
+    scenario, selection_history, ending, next_page = get_review(
+        user_id,
+        scenario_id,
+        slot=slot,
+        start=request.args.get("start", type=int, default=0),
+        compact=compact,
+    )
+    if not scenario:
+        abort(404)
+    if next_page:
+        next_page = url_for(
+            request.endpoint,
+            **request.view_args,
+            **next_page,
+            slot=slot,
+            compact=compact,
+        )
+
+    template = "review_items.html" if request.args.get("partial") else "review.html"
+    return render_template(
+        template,
+        scenario=scenario,
+        selection_history=selection_history,
+        ending=ending,
+        next_page=next_page,
+        compact=compact,
+        slot=slot,
+        **context,
+    )
+
+
+# 検索結果の最大件数
+SEARCH_LIMIT = 100
+# 検索語の前後に表示する文字数
+SEARCH_SNIPPET_LENGTH = 32
+# 検索語の強調箇所を示す制御文字(エスケープ後に<mark>タグへ置き換える)
+MARK_START, MARK_END = "\x02", "\x03"
+
+
+def highlight(snippet):
+    return (
+        str(escape(snippet))
+        .replace(MARK_START, "<mark>")
+        .replace(MARK_END, "</mark>")
+    )
+
+
+def make_snippet(text, terms):
+    """検索語を含む部分を切り出して強調する(索引を使えない短い検索語用)"""
+    position = min((text.find(term) for term in terms if term in text), default=0)
+    start = max(position - SEARCH_SNIPPET_LENGTH // 2, 0)
+    snippet = text[start : start + SEARCH_SNIPPET_LENGTH * 2]
+    for term in terms:
+        snippet = snippet.replace(term, f"{MARK_START}{term}{MARK_END}")
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + SEARCH_SNIPPET_LENGTH * 2 < len(text) else ""
+    return prefix + snippet + suffix
+
+
+@transact(app.config["ARGS"].database)
+def search_scenes(db: sqlite3.Connection, query, limit=SEARCH_LIMIT):
+    """公開中のシナリオのシーンと選択肢の本文を全文検索する"""
+    terms = query.split()
+    if not terms:
+        return []
+
+    if all(len(term) >= 3 for term in terms):
+        # 検索語はフレーズとして扱い、全てを含むシーンを関連度の順に取得
+        match = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        rows = db.execute(
+            """
+            SELECT
+                sc.id AS scenario_id,
+                sc.title,
+                s.scene_id,
+                snippet(scene_search, 0, ?, ?, '…', ?) AS scene_snippet,
+                snippet(scene_search, 1, ?, ?, '…', ?) AS selection_snippet
+            FROM scene_search
+            JOIN scenes s ON s.id = scene_search.rowid
+            JOIN scenarios sc ON sc.current_version_id = s.version_id
+            WHERE scene_search MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            """,
+            (MARK_START, MARK_END, SEARCH_SNIPPET_LENGTH) * 2 + (match, limit),
+        ).fetchall()
+        hits = [dict(row) for row in rows]
+    else:
+        # trigramの索引は3文字未満の検索語に使えないため本文を順に確認する
+        condition = " AND ".join(
+            "(INSTR(scene_search.scene_text, ?) OR INSTR(scene_search.selection_text, ?))"
+            for _ in terms
+        )
+        rows = db.execute(
+            f"""
+            SELECT
+                sc.id AS scenario_id,
+                sc.title,
+                s.scene_id,
+                scene_search.scene_text,
+                scene_search.selection_text
+            FROM scene_search
+            JOIN scenes s ON s.id = scene_search.rowid
+            JOIN scenarios sc ON sc.current_version_id = s.version_id
+            WHERE {condition}
+            LIMIT ?
+            """,
+            (*[term for term in terms for _ in range(2)], limit),
+        ).fetchall()
+        hits = [
+            {
+                "scenario_id": row["scenario_id"],
+                "title": row["title"],
+                "scene_id": row["scene_id"],
+                "scene_snippet": make_snippet(row["scene_text"], terms),
+                "selection_snippet": make_snippet(row["selection_text"] or "", terms),
+            }
+            for row in rows
+        ]
+
+    # 検索語を含まない本文は表示しない
+    for hit in hits:
+        for key in ("scene_snippet", "selection_snippet"):
+            snippet = hit[key] or ""
+            hit[key] = highlight(snippet) if MARK_START in snippet else ""
+    return hits
 
 
 @app.route("/")
@@ -535,7 +2071,7 @@ def admin_login(db: sqlite3.Connection):
             "SELECT * FROM admins WHERE username = ?", (username,)
         ).fetchone()
 
-        if admin and check_password_hash(admin["password"], password):
+        if admin and verify_password(admin["password"], password):
             session["admin_id"] = admin["id"]
             return redirect(url_for("admin"))
 
@@ -555,9 +2091,9 @@ def admin_logout():
 @transact(app.config["ARGS"].database)
 def admin(db: sqlite3.Connection):
     total_users = db.execute("SELECT COUNT(*) as total FROM users").fetchone()["total"]
-    total_scenarios = db.execute("SELECT COUNT(*) as total FROM scenarios").fetchone()[
-        "total"
-    ]
+    total_scenarios = db.execute(
+        "SELECT COUNT(*) as total FROM scenarios WHERE current_version_id IS NOT NULL"
+    ).fetchone()["total"]
     return render_template(
         "admin.html",
         total_users=total_users,
@@ -576,16 +2112,15 @@ def user_list(db: sqlite3.Connection):
             if not files:
                 flash("No CSV files were uploaded!", "alert")
             for file in files:
-                filepath = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
-                file.save(filepath)
-                register_from_csv(filepath)
-                os.remove(filepath)
-                flash("User registration successful!", "success")
+                enqueue_job("register_from_csv", file.filename, file.read())
+                flash(f"User registration ({file.filename}) queued!", "success")
         except Exception:
             flash("User registration failed!", "error")
 
     users = db.execute("SELECT id, username FROM users ORDER BY id").fetchall()
-    return render_template("user_list.html", users=users)
+    return render_template(
+        "user_list.html", users=users, jobs=list_jobs("register_from_csv")
+    )
 
 
 @app.route("/admin/scenarios", methods=["GET", "POST"])
@@ -595,36 +2130,84 @@ def scenarios(db: sqlite3.Connection):
     if request.method == "POST":
         try:
             files = request.files.getlist("files[]")
-            files = [file for file in files if file.filename.endswith(".json")]
+            files = [
+                file for file in files if file.filename.endswith((".json", EXTENSION))
+            ]
             if not files:
-                flash("No JSON files were uploaded!", "alert")
+                flash("No scenario files were uploaded!", "alert")
             for file in files:
-                filepath = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
-                file.save(filepath)
-                title = import_scenario(filepath)
-                os.remove(filepath)
-                flash(f"Scenario ({title}) registration successful!", "success")
+                enqueue_job("import_scenario", file.filename, file.read())
+                flash(f"Scenario ({file.filename}) import queued!", "success")
         except Exception:
             flash("Scenario registration failed!", "error")
 
-    scenarios = db.execute(
+    # シナリオごとのプレイ状況は各シャードで集計してから合算する
+    play_counts = {}
+    for row in query_play_shards(
         """
-        WITH user_counts AS (
-            SELECT COUNT(*) as total_users FROM users
-        )
         SELECT
-            s.*,
-            COUNT(CASE WHEN p.is_completed = 1 THEN 1 END) AS completed_users,
-            COUNT(CASE WHEN p.is_completed = 0 THEN 1 END) AS uncompleted_users,
-            uc.total_users
-        FROM scenarios s
-        CROSS JOIN user_counts uc
-        LEFT JOIN play_history p ON s.id = p.scenario_id
-        GROUP BY s.id, uc.total_users
-        ORDER BY s.id
+            scenario_id,
+            COUNT(DISTINCT CASE WHEN is_completed = 1 THEN user_id END) AS completed_users,
+            COUNT(DISTINCT CASE WHEN is_completed = 0 THEN user_id END) AS uncompleted_users
+        FROM play_history
+        GROUP BY scenario_id
         """
+    ):
+        counts = play_counts.setdefault(row["scenario_id"], [0, 0])
+        counts[0] += row["completed_users"]
+        counts[1] += row["uncompleted_users"]
+
+    total_users = db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    scenarios = [
+        {
+            **scenario,
+            "completed_users": play_counts.get(scenario["id"], [0, 0])[0],
+            "uncompleted_users": play_counts.get(scenario["id"], [0, 0])[1],
+            "total_users": total_users,
+        }
+        for scenario in db.execute(
+            "SELECT * FROM scenarios WHERE current_version_id IS NOT NULL ORDER BY id"
+        )
+    ]
+    scenario_files = db.execute(
+        "SELECT * FROM scenario_files ORDER BY path"
     ).fetchall()
-    return render_template("scenario_list.html", scenarios=scenarios, admin=True)
+    return render_template(
+        "scenario_list.html",
+        scenarios=scenarios,
+        scenario_files=scenario_files,
+        jobs=list_jobs("import_scenario"),
+        admin=True,
+    )
+
+
+@app.route("/admin/search")
+@admin_required
+def search():
+    query = request.args.get("q", "").strip()
+    hits = search_scenes(query) if query else []
+    if request.args.get("format") == "json":
+        return jsonify(hits)
+    return render_template("search.html", query=query, hits=hits, limit=SEARCH_LIMIT)
+
+
+@app.route("/admin/jobs/<int:job_id>")
+@admin_required
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route("/admin/jobs/<int:job_id>/cancel", methods=["POST"])
+@admin_required
+def job_cancel(job_id):
+    cancel_job(job_id)
+    job = get_job(job_id)
+    if not job:
+        abort(404)
+    return jsonify(job)
 
 
 @app.before_request
@@ -634,6 +2217,115 @@ def handle_flash_message():
         flash(message["text"], message["type"])
 
 
+# 計測しないエンドポイント(計測画面自体と、接続し続けるイベント配信)
+PROFILE_EXCLUDED_ENDPOINTS = {"static", "profiling", "live_stream"}
+
+
+@app.before_request
+def begin_profile():
+    if profiler.enabled and request.endpoint not in PROFILE_EXCLUDED_ENDPOINTS:
+        g.profile = profiler.begin(request.method, request.path, request.endpoint)
+
+
+@app.teardown_request
+def end_profile(exc=None):
+    profile = g.pop("profile", None)
+    if profile:
+        profiler.record(profile)
+
+
+@before_render_template.connect_via(app)
+def begin_template_profile(sender, **extra):
+    profile = request_profile()
+    if profile:
+        profile.begin_stage("template")
+
+
+@template_rendered.connect_via(app)
+def end_template_profile(sender, **extra):
+    profile = request_profile()
+    if profile:
+        profile.end_stage("template")
+
+
+@app.route("/admin/profiler", methods=["GET", "POST"])
+@admin_required
+def profiling():
+    if request.method == "POST":
+        action = request.form.get("action")
+        if action == "enable":
+            profiler.enabled = True
+        elif action == "disable":
+            profiler.enabled = False
+        elif action == "reset":
+            profiler.reset()
+        return redirect(url_for("profiling"))
+
+    report = profiler.report()
+    if request.args.get("format") == "json":
+        return jsonify(report)
+    return render_template("profiler.html", **report)
+
+
+@app.route("/admin/live")
+@admin_required
+@transact(app.config["ARGS"].database)
+def live(db: sqlite3.Connection):
+    scenarios = db.execute("SELECT id, title FROM scenarios ORDER BY id").fetchall()
+    plays = query_play_shards(
+        """
+        SELECT
+            ph.user_id,
+            u.username,
+            ph.scenario_id,
+            ph.current_scene_id AS scene_id,
+            ph.is_completed,
+            ph.updated_at AS time
+        FROM play_history ph
+        JOIN users u ON ph.user_id = u.id
+        ORDER BY ph.updated_at DESC
+        LIMIT ?
+        """,
+        (LIVE_SNAPSHOT_SIZE,),
+    )
+    # 各シャードの最新のプレイをまとめて並べ直す
+    plays = sorted(plays, key=lambda play: play["time"], reverse=True)[
+        :LIVE_SNAPSHOT_SIZE
+    ]
+    return render_template(
+        "live.html",
+        scenarios={scenario["id"]: scenario["title"] for scenario in scenarios},
+        plays=[dict(play) for play in plays],
+    )
+
+
+@app.route("/admin/live/stream")
+@admin_required
+def live_stream():
+    subscription = event_broker.subscribe()
+
+    def stream():
+        try:
+            while True:
+                events, dropped = subscription.get(LIVE_KEEPALIVE_INTERVAL)
+                if dropped:
+                    # 取りこぼしたイベントがある場合は画面全体を読み直させる
+                    yield "event: resync\ndata: {}\n\n"
+                for event in events:
+                    data = json.dumps(event, ensure_ascii=False)
+                    yield f"event: {event['type']}\ndata: {data}\n\n"
+                if not events and not dropped:
+                    yield ": keepalive\n\n"
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/admin/users/<int:user_id>/password", methods=["POST"])
 @admin_required
 @transact(app.config["ARGS"].database)
@@ -659,7 +2351,7 @@ def change_user_password(db: sqlite3.Connection, user_id):
     try:
         db.execute(
             "UPDATE users SET password = ? WHERE id = ?",
-            (generate_password_hash(new_password), user_id),
+            (hash_password(new_password), user_id),
         )
         # セッションに一時的なメッセージを保存
         session["flash_message"] = {
@@ -678,29 +2370,20 @@ def change_user_password(db: sqlite3.Connection, user_id):
 
 @app.route("/admin/users/<int:user_id>")
 @admin_required
-@transact(app.config["ARGS"].database)
+@transact(app.config["ARGS"].database, route=user_shard)
 def user_info(db: sqlite3.Connection, user_id):
     user = db.execute(
         "SELECT id, username FROM users WHERE id= ?", (user_id,)
     ).fetchone()
-    ended_scenarios = db.execute(
-        """
-        WITH first_scenes AS (
-            SELECT DISTINCT scenario_id, scene_id as first_scene_id
-            FROM scenes
-            GROUP BY scenario_id
-            ORDER BY scenario_id, scene_id
-        )
-        SELECT s.*, ph.current_scene_id, ph.is_completed, fs.first_scene_id
-        FROM scenarios s
-        LEFT JOIN play_history ph ON s.id = ph.scenario_id AND ph.user_id = ?
-        LEFT JOIN first_scenes fs ON s.id = fs.scenario_id
-        ORDER BY s.id
-        """,
-        (user_id,),
+    scenarios = db.execute(
+        "SELECT * FROM scenarios WHERE current_version_id IS NOT NULL ORDER BY id"
     ).fetchall()
 
-    return render_template("scenario_list.html", scenarios=ended_scenarios, user=user)
+    return render_template(
+        "scenario_list.html",
+        scenarios=load_save_slots(db, user_id, scenarios),
+        user=user,
+    )
 
 
 @app.route("/admin/users/<int:user_id>/<int:scenario_id>")
@@ -710,15 +2393,7 @@ def user_review(db: sqlite3.Connection, user_id, scenario_id):
     user = db.execute(
         "SELECT id, username FROM users WHERE id= ?", (user_id,)
     ).fetchone()
-    scenario, selection_history, ending = get_review(user_id, scenario_id)
-
-    return render_template(
-        "review.html",
-        scenario=scenario,
-        selection_history=selection_history,
-        ending=ending,
-        user=user,
-    )
+    return render_review(user_id, scenario_id, user=user)
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -733,8 +2408,9 @@ def register(db: sqlite3.Connection):
         try:
             db.execute(
                 "INSERT INTO users (username, password) VALUES (?, ?)",
-                (username, generate_password_hash(password)),
+                (username, hash_password(password)),
             )
+            assign_shards(db)
             flash("Registration successful!", "success")
             return redirect(url_for("login"))
         except sqlite3.IntegrityError:
@@ -754,8 +2430,9 @@ def login(db: sqlite3.Connection):
             "SELECT * FROM users WHERE username = ?", (username,)
         ).fetchone()
 
-        if user and check_password_hash(user["password"], password):
+        if user and verify_password(user["password"], password):
             session["user_id"] = user["id"]
+            session["username"] = user["username"]
             return redirect(url_for("scenario_list"))
 
         flash("Invalid username or password!", "alert")
@@ -766,31 +2443,22 @@ def login(db: sqlite3.Connection):
 @app.route("/logout")
 def logout():
     session.pop("user_id", None)
+    session.pop("username", None)
     return redirect(url_for("login"))
 
 
 @app.route("/scenarios")
 @login_required
-@transact(app.config["ARGS"].database)
+@transact(app.config["ARGS"].database, route=session_shard)
 def scenario_list(db: sqlite3.Connection):
     scenarios = db.execute(
-        """
-        WITH first_scenes AS (
-            SELECT DISTINCT scenario_id, scene_id as first_scene_id
-            FROM scenes
-            GROUP BY scenario_id
-            ORDER BY scenario_id, scene_id
-        )
-        SELECT s.*, ph.current_scene_id, ph.is_completed, fs.first_scene_id
-        FROM scenarios s
-        LEFT JOIN play_history ph ON s.id = ph.scenario_id AND ph.user_id = ?
-        LEFT JOIN first_scenes fs ON s.id = fs.scenario_id
-        ORDER BY s.id
-        """,
-        (session["user_id"],),
+        "SELECT * FROM scenarios WHERE current_version_id IS NOT NULL ORDER BY id"
     ).fetchall()
 
-    return render_template("scenario_list.html", scenarios=scenarios)
+    return render_template(
+        "scenario_list.html",
+        scenarios=load_save_slots(db, session["user_id"], scenarios),
+    )
 
 
 @app.route(f"/{app.config['IMAGE_BASE']}/<path:path>")
@@ -801,70 +2469,68 @@ def send_image(path):
 
 @app.route("/play/<int:scenario_id>/start")
 @login_required
-@transact(app.config["ARGS"].database)
+@transact(app.config["ARGS"].database, route=session_shard)
 def start_scenario(db: sqlite3.Connection, scenario_id):
-    # 最初のシーンを取得
+    # スロットのプレイ履歴を公開中のバージョンの最初のシーンから始まる状態で上書き
+    # (公開中のバージョンの取得と固定を1文で行い、その間に旧バージョンが削除されないようにする)
+    slot = request_slot()
     first_scene = db.execute(
         """
-        SELECT scene_id
-        FROM scenes
-        WHERE scenario_id = ?
-        ORDER BY scene_id
+        INSERT INTO play_history (
+            user_id, scenario_id, slot, version_id, current_scene_id, is_completed, seed
+        )
+        SELECT ?, sc.id, ?, s.version_id, s.scene_id, 0, ?
+        FROM scenarios sc
+        JOIN scenes s ON s.version_id = sc.current_version_id
+        WHERE sc.id = ?
+        ORDER BY s.scene_id
         LIMIT 1
+        ON CONFLICT (user_id, scenario_id, slot) DO UPDATE SET
+            version_id = excluded.version_id,
+            current_scene_id = excluded.current_scene_id,
+            is_completed = 0,
+            seed = excluded.seed,
+            rng_step = 0,
+            path = X'',
+            created_at = DATETIME('now', 'localtime'),
+            updated_at = DATETIME('now', 'localtime')
+        RETURNING version_id, current_scene_id AS scene_id
         """,
-        (scenario_id,),
+        (session["user_id"], slot, new_seed(), scenario_id),
     ).fetchone()
 
     if not first_scene:
         flash("Scenario not found!", "error")
         return redirect(url_for("scenario_list"))
 
-    # 既存のプレイ履歴を削除
-    db.execute(
-        """
-        DELETE FROM selection_history
-        WHERE play_history_id IN (
-            SELECT id FROM play_history
-            WHERE user_id = ? AND scenario_id = ?
-        )
-        """,
-        (session["user_id"], scenario_id),
-    )
-    db.execute(
-        """
-        DELETE FROM play_history
-        WHERE user_id = ? AND scenario_id = ?
-        """,
-        (session["user_id"], scenario_id),
-    )
-
-    # 新しいプレイ履歴を作成
-    db.execute(
-        """
-        INSERT INTO play_history (user_id, scenario_id, current_scene_id, is_completed)
-        VALUES (?, ?, ?, 0)
-        """,
-        (session["user_id"], scenario_id, first_scene["scene_id"]),
+    after_commit(
+        db,
+        event_broker.publish,
+        "start",
+        session["user_id"],
+        scenario_id,
+        username=session.get("username"),
+        scene_id=first_scene["scene_id"],
     )
-
-    return redirect(url_for("play_scenario", scenario_id=scenario_id))
+    return redirect(url_for("play_scenario", scenario_id=scenario_id, slot=slot))
 
 
 @app.route("/play/<int:scenario_id>")
 @login_required
-@transact(app.config["ARGS"].database)
+@transact(app.config["ARGS"].database, route=session_shard)
 def play_scenario(db: sqlite3.Connection, scenario_id):
     # プレイ履歴を取得
+    slot = request_slot()
     play_history = db.execute(
         """
         SELECT * FROM play_history
-        WHERE user_id = ? AND scenario_id = ?
+        WHERE user_id = ? AND scenario_id = ? AND slot = ?
         """,
-        (session["user_id"], scenario_id),
+        (session["user_id"], scenario_id, slot),
     ).fetchone()
 
     if not play_history:
-        return redirect(url_for("start_scenario", scenario_id=scenario_id))
+        return redirect(url_for("start_scenario", scenario_id=scenario_id, slot=slot))
 
     # 現在のシーンを取得
     current_scene = db.execute(
@@ -872,11 +2538,16 @@ def play_scenario(db: sqlite3.Connection, scenario_id):
         SELECT s.*, sc.title as scenario_title
         FROM scenes s
         JOIN scenarios sc ON s.scenario_id = sc.id
-        WHERE s.scenario_id = ? AND s.scene_id = ?
+        WHERE s.version_id = ? AND s.scene_id = ?
         """,
-        (scenario_id, play_history["current_scene_id"]),
+        (play_history["version_id"], play_history["current_scene_id"]),
     ).fetchone()
 
+    # プレイ中のバージョンが削除されている場合は最初からやり直す
+    if not current_scene:
+        flash("Scenario has been updated. Please start again.", "alert")
+        return redirect(url_for("start_scenario", scenario_id=scenario_id, slot=slot))
+
     # 選択肢を取得
     selections = db.execute(
         "SELECT * FROM selections WHERE scene_id = ? ORDER BY id",
@@ -884,18 +2555,22 @@ def play_scenario(db: sqlite3.Connection, scenario_id):
     ).fetchall()
 
     return render_template(
-        "play.html", scenario_id=scenario_id, scene=current_scene, selections=selections
+        "play.html",
+        scenario_id=scenario_id,
+        slot=slot,
+        scene=current_scene,
+        selections=selections,
     )
 
 
 @app.route("/play/<int:scenario_id>/select/<int:selection_id>", methods=["POST"])
 @login_required
-@transact(app.config["ARGS"].database)
+@transact(app.config["ARGS"].database, route=session_shard)
 def make_selection(db: sqlite3.Connection, scenario_id, selection_id):
     # 選択肢の情報を取得
     selection = db.execute(
         """
-        SELECT s.*, sc.scene_id as current_scene_id
+        SELECT s.*, sc.scene_id as current_scene_id, sc.version_id
         FROM selections s
         JOIN scenes sc ON s.scene_id = sc.id
         WHERE s.id = ?
@@ -903,74 +2578,94 @@ def make_selection(db: sqlite3.Connection, scenario_id, selection_id):
         (selection_id,),
     ).fetchone()
 
-    if not selection:
-        flash("Invalid selection!", "alert")
-        return redirect(url_for("play_scenario", scenario_id=scenario_id))
-
     # プレイ履歴を取得
+    slot = request_slot()
     play_history = db.execute(
         """
         SELECT * FROM play_history
-        WHERE user_id = ? AND scenario_id = ?
+        WHERE user_id = ? AND scenario_id = ? AND slot = ?
         """,
-        (session["user_id"], scenario_id),
+        (session["user_id"], scenario_id, slot),
     ).fetchone()
 
-    # 選択履歴を保存
-    db.execute(
-        """
-        INSERT INTO selection_history (play_history_id, scene_id, selection_id)
-        VALUES (?, ?, ?)
-        """,
-        (play_history["id"], selection["scene_id"], selection_id),
-    )
-
-    # 次のシーンの情報を取得
-    next_ids = db.execute(
-        "SELECT next_id FROM next_scenes WHERE selection_id = ? ORDER BY id",
-        (selection_id,),
-    ).fetchall()
-    next_ids = list(map(lambda x: x["next_id"], next_ids))
-    next_id = random.choice(next_ids)
+    # プレイ中のバージョン以外の選択肢は受け付けない
+    if (
+        not selection
+        or not play_history
+        or selection["version_id"] != play_history["version_id"]
+    ):
+        flash("Invalid selection!", "alert")
+        return redirect(url_for("play_scenario", scenario_id=scenario_id, slot=slot))
+
+    # 次のシーンをプレイごとの乱数で選ぶ(遷移先が1つの場合は乱数を使わない)
+    seed = play_history["seed"]
+    if seed is None:
+        seed = new_seed()
+    rng_step = play_history["rng_step"]
+    next_table = selection["next_table"]
+    if len(next_table) > ALIAS.size:
+        next_id = pick_next_scene(next_table, *play_random(seed, rng_step))
+        rng_step += 1
+    else:
+        next_id = pick_next_scene(next_table, 0, 0)
     next_scene = db.execute(
         """
         SELECT id, is_end FROM scenes
-        WHERE scenario_id = ? AND scene_id = ?
+        WHERE version_id = ? AND scene_id = ?
         """,
-        (scenario_id, next_id),
+        (play_history["version_id"], next_id),
     ).fetchone()
 
-    # プレイ履歴を更新
+    # 選択した選択肢を経路の末尾に追加してプレイ履歴を更新
     db.execute(
         """
         UPDATE play_history
-        SET current_scene_id = ?, is_completed = ?
+        SET current_scene_id = ?, is_completed = ?, seed = ?, rng_step = ?, path = ?,
+            updated_at = DATETIME('now', 'localtime')
         WHERE id = ?
         """,
-        (next_id, next_scene["is_end"], play_history["id"]),
+        (
+            next_id,
+            next_scene["is_end"],
+            seed,
+            rng_step,
+            play_history["path"] + pack_ids([selection_id]),
+            play_history["id"],
+        ),
     )
 
+    after_commit(
+        db,
+        event_broker.publish,
+        "ending" if next_scene["is_end"] else "select",
+        session["user_id"],
+        scenario_id,
+        username=session.get("username"),
+        scene_id=next_id,
+        selection=selection["text"],
+    )
     if next_scene["is_end"]:
-        return redirect(url_for("show_ending", scenario_id=scenario_id))
+        return redirect(url_for("show_ending", scenario_id=scenario_id, slot=slot))
 
-    return redirect(url_for("play_scenario", scenario_id=scenario_id))
+    return redirect(url_for("play_scenario", scenario_id=scenario_id, slot=slot))
 
 
 @app.route("/play/<int:scenario_id>/ending")
 @login_required
-@transact(app.config["ARGS"].database)
+@transact(app.config["ARGS"].database, route=session_shard)
 def show_ending(db: sqlite3.Connection, scenario_id):
     # プレイ履歴を取得
+    slot = request_slot()
     play_history = db.execute(
         """
         SELECT * FROM play_history
-        WHERE user_id = ? AND scenario_id = ?
+        WHERE user_id = ? AND scenario_id = ? AND slot = ?
         """,
-        (session["user_id"], scenario_id),
+        (session["user_id"], scenario_id, slot),
     ).fetchone()
 
     if not play_history:
-        return redirect(url_for("start_scenario", scenario_id=scenario_id))
+        return redirect(url_for("start_scenario", scenario_id=scenario_id, slot=slot))
 
     # 現在のシーンを取得
     current_scene = db.execute(
@@ -978,11 +2673,16 @@ def show_ending(db: sqlite3.Connection, scenario_id):
         SELECT s.*, sc.title as scenario_title
         FROM scenes s
         JOIN scenarios sc ON s.scenario_id = sc.id
-        WHERE s.scenario_id = ? AND s.scene_id = ?
+        WHERE s.version_id = ? AND s.scene_id = ?
         """,
-        (scenario_id, play_history["current_scene_id"]),
+        (play_history["version_id"], play_history["current_scene_id"]),
     ).fetchone()
 
+    # プレイ中のバージョンが削除されている場合は最初からやり直す
+    if not current_scene:
+        flash("Scenario has been updated. Please start again.", "alert")
+        return redirect(url_for("start_scenario", scenario_id=scenario_id, slot=slot))
+
     # 選択肢を取得
     selections = db.execute(
         "SELECT * FROM selections WHERE scene_id = ? ORDER BY id",
@@ -992,6 +2692,7 @@ def show_ending(db: sqlite3.Connection, scenario_id):
     return render_template(
         "ending.html",
         scenario_id=scenario_id,
+        slot=slot,
         scene=current_scene,
         selections=selections,
     )
@@ -1000,18 +2701,19 @@ def show_ending(db: sqlite3.Connection, scenario_id):
 @app.route("/play/<int:scenario_id>/review")
 @login_required
 def show_review(scenario_id):
-    scenario, selection_history, ending = get_review(session["user_id"], scenario_id)
-
-    return render_template(
-        "review.html",
-        scenario=scenario,
-        selection_history=selection_history,
-        ending=ending,
-    )
+    return render_review(session["user_id"], scenario_id)
 
 
 def main():
+    report_startup("import")
     init_db()
+    init_shards()
+    cleanup_scenario_versions()
+    export_snapshot()
+    report_startup("database")
+    # 最初のリクエストでコンパイルが発生しないよう事前に読み込む
+    warm_template_cache(app.jinja_env)
+    report_startup("templates")
     if app.config["ARGS"].admin:
         try:
             admin_register_from_csv(app.config["ARGS"].admin)
@@ -1030,7 +2732,13 @@ def main():
             print(f"Imported scenario: {title}")
         except Exception:
             print(f"Import scenario failed: {scenario_json}")
+    # リローダー使用時は実際にリクエストを処理するプロセスでのみ実行する
+    if not app.config["DEBUG"] or is_running_from_reloader():
+        start_job_workers()
+        if app.config["ARGS"].watch:
+            start_scenario_watcher(app.config["ARGS"].watch)
 
+    report_startup("ready")
     app.run(host="0.0.0.0", port=app.config["ARGS"].port, debug=app.config["DEBUG"])
 
 
@@ -1,27 +1,72 @@
+import argparse
+import os
+import shutil
+
 import PyInstaller.__main__
+from flask import Flask
+
+from template_cache import TemplateBytecodeCache, warm_template_cache
 
+# 実行時に使用しない標準ライブラリ等を除外して展開・読み込みの量を減らす
+EXCLUDES = [
+    "tkinter",
+    "unittest",
+    "test",
+    "lib2to3",
+    "pydoc_data",
+    "idlelib",
+    "turtle",
+    "turtledemo",
+    "curses",
+    "xmlrpc",
+    "distutils",
+    "setuptools",
+    "pkg_resources",
+    "PyInstaller",
+]
+TEMPLATE_CACHE = os.path.join("build", "template_cache")
 
-def build_exe():
-    PyInstaller.__main__.run(
-        [
-            "app.py",
-            "--onefile",
-            "--clean",
-            "--hidden-import",
-            "flask",
-            "--hidden-import",
-            "python-dotenv",
-            "--hidden-import",
-            "jsonschema",
-            "--name",
-            "text_adventure_engine",
-            "--add-data",
-            "templates:templates",
-            "--add-data",
-            "static:static",
-        ]
+
+def define_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--onedir",
+        action="store_true",
+        help="起動の速いフォルダ形式で出力(展開処理が不要)",
     )
+    return parser.parse_args()
+
+
+def compile_templates():
+    """テンプレートをコンパイルしたバイトコードを実行ファイルに同梱するため出力する"""
+    shutil.rmtree(TEMPLATE_CACHE, ignore_errors=True)
+    os.makedirs(TEMPLATE_CACHE)
+    app = Flask("app", root_path=os.path.dirname(os.path.abspath(__file__)))
+    app.jinja_env.bytecode_cache = TemplateBytecodeCache(TEMPLATE_CACHE)
+    warm_template_cache(app.jinja_env)
+
+
+def build_exe(onedir=False):
+    compile_templates()
+
+    options = [
+        "app.py",
+        "--onedir" if onedir else "--onefile",
+        "--clean",
+        "--name",
+        "text_adventure_engine",
+        "--add-data",
+        "templates:templates",
+        "--add-data",
+        "static:static",
+        "--add-data",
+        f"{TEMPLATE_CACHE}:template_cache",
+    ]
+    for module in EXCLUDES:
+        options += ["--exclude-module", module]
+    PyInstaller.__main__.run(options)
 
 
 if __name__ == "__main__":
-    build_exe()
+    args = define_argparse()
+    build_exe(args.onedir)
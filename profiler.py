@@ -0,0 +1,264 @@
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# 実行計画を取得する文の種類(それ以外の文は計測のみ行う)
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+# 遅いリクエストごとに保持する文の数
+SLOW_STATEMENTS = 20
+
+
+def normalize_sql(sql):
+    return " ".join(sql.split())
+
+
+def plan_warning(detail):
+    """実行計画の1行が全件走査または一時B木の使用であれば種類を返す"""
+    if "TEMP B-TREE" in detail:
+        return "temp b-tree"
+    if (
+        detail.startswith("SCAN ")
+        and " USING " not in detail
+        and "VIRTUAL TABLE" not in detail
+        and detail != "SCAN CONSTANT ROW"
+    ):
+        return "full scan"
+    return None
+
+
+def explain(conn, sql, parameters):
+    """EXPLAIN QUERY PLAN の結果を階層の深さ付きで返す"""
+    try:
+        rows = sqlite3.Cursor(conn).execute(
+            f"EXPLAIN QUERY PLAN {sql}", parameters
+        )
+        depths = {0: -1}
+        plan = []
+        for id, parent, _, detail in rows:
+            depths[id] = depths.get(parent, -1) + 1
+            plan.append(
+                {"depth": depths[id], "detail": detail, "warning": plan_warning(detail)}
+            )
+        return plan
+    except sqlite3.Error as e:
+        return [{"depth": 0, "detail": f"EXPLAIN failed: {e}", "warning": None}]
+
+
+class RequestProfile:
+    """1リクエスト分の計測結果"""
+
+    def __init__(self, method, path, endpoint):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.time = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.started = time.perf_counter()
+        self.total = 0.0
+        self.stages = {"kdf": 0.0, "template": 0.0}
+        self.stage_started = {}
+        self.statements = []
+        self.plans = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def begin_stage(self, name):
+        self.stage_started[name] = time.perf_counter()
+
+    def end_stage(self, name):
+        started = self.stage_started.pop(name, None)
+        if started is not None:
+            self.stages[name] += time.perf_counter() - started
+
+    def statement(self, sql):
+        entry = {"sql": normalize_sql(sql), "time": 0.0}
+        self.statements.append(entry)
+        return entry
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        db = sum(entry["time"] for entry in self.statements)
+        self.stages["db"] = db
+        self.stages["other"] = max(
+            self.total - db - self.stages["kdf"] - self.stages["template"], 0.0
+        )
+
+    def to_dict(self):
+        statements = sorted(
+            self.statements, key=lambda entry: entry["time"], reverse=True
+        )
+        return {
+            "method": self.method,
+            "path": self.path,
+            "endpoint": self.endpoint,
+            "time": self.time,
+            "total_ms": self.total * 1000,
+            "stages_ms": {name: value * 1000 for name, value in self.stages.items()},
+            "statement_count": len(self.statements),
+            "statements": [
+                {"sql": entry["sql"], "time_ms": entry["time"] * 1000}
+                for entry in statements[:SLOW_STATEMENTS]
+            ],
+        }
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """実行と結果の取得にかかった時間をリクエストの計測結果に加えるカーソル"""
+
+    entry = None
+
+    def execute(self, sql, parameters=()):
+        self.entry = self.connection.profile.statement(sql)
+        self.timed(super().execute, sql, parameters)
+        self.connection.explain(self.entry["sql"], sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.entry = self.connection.profile.statement(sql)
+        self.timed(super().executemany, sql, seq_of_parameters)
+        # パラメータの列は使い切っているため、計画はNULLを当てはめて取得する
+        self.connection.explain(self.entry["sql"], sql, (None,) * sql.count("?"))
+        return self
+
+    def timed(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self.entry is not None:
+                self.entry["time"] += time.perf_counter() - started
+
+    def fetchone(self):
+        return self.timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self.timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self.timed(super().fetchall)
+
+    def __next__(self):
+        return self.timed(super().__next__)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """実行した文をリクエストの計測結果に記録する接続"""
+
+    profiler = None
+    profile = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def explain(self, key, sql, parameters):
+        """ルートごとに文の実行計画を1度だけ取得する"""
+        if not key.upper().startswith(EXPLAINABLE):
+            return
+        if key in self.profile.plans or self.profiler.has_plan(
+            self.profile.endpoint, key
+        ):
+            return
+        self.profile.plans[key] = explain(self, sql, parameters)
+
+
+class Profiler:
+    """ルートごとのSQLの集計と、遅いリクエストの記録
+
+    無効な間は計測用の接続やリクエストの記録を作らない
+    """
+
+    def __init__(self, size, enabled=False):
+        self.size = size
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+            self.plans = {}
+            self.slowest = []
+            self.counter = itertools.count()
+
+    def has_plan(self, endpoint, sql):
+        return (endpoint, sql) in self.plans
+
+    def begin(self, method, path, endpoint):
+        return RequestProfile(method, path, endpoint)
+
+    def record(self, profile):
+        profile.finish()
+        with self.lock:
+            for sql, plan in profile.plans.items():
+                self.plans.setdefault((profile.endpoint, sql), plan)
+
+            route = self.routes.setdefault(
+                profile.endpoint,
+                {"count": 0, "total": 0.0, "max": 0.0, "statements": {}},
+            )
+            route["count"] += 1
+            route["total"] += profile.total
+            route["max"] = max(route["max"], profile.total)
+            for entry in profile.statements:
+                statement = route["statements"].setdefault(
+                    entry["sql"], {"count": 0, "total": 0.0, "max": 0.0}
+                )
+                statement["count"] += 1
+                statement["total"] += entry["time"]
+                statement["max"] = max(statement["max"], entry["time"])
+
+            # 最も速いものを入れ替えて、遅い順に size 件だけ残す
+            item = (profile.total, next(self.counter), profile.to_dict())
+            if len(self.slowest) < self.size:
+                heapq.heappush(self.slowest, item)
+            elif item[0] > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def report(self):
+        with self.lock:
+            routes = []
+            for endpoint, route in self.routes.items():
+                statements = []
+                for sql, statement in route["statements"].items():
+                    plan = self.plans.get((endpoint, sql), [])
+                    statements.append(
+                        {
+                            "sql": sql,
+                            "count": statement["count"],
+                            "total_ms": statement["total"] * 1000,
+                            "max_ms": statement["max"] * 1000,
+                            "plan": plan,
+                            "warnings": sorted(
+                                {row["warning"] for row in plan if row["warning"]}
+                            ),
+                        }
+                    )
+                statements.sort(key=lambda statement: statement["total_ms"], reverse=True)
+                routes.append(
+                    {
+                        "endpoint": endpoint,
+                        "count": route["count"],
+                        "total_ms": route["total"] * 1000,
+                        "max_ms": route["max"] * 1000,
+                        "statements": statements,
+                    }
+                )
+            routes.sort(key=lambda route: route["total_ms"], reverse=True)
+            slowest = [
+                item[2] for item in sorted(self.slowest, key=lambda item: -item[0])
+            ]
+        return {"enabled": self.enabled, "routes": routes, "slowest": slowest}
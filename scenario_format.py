@@ -0,0 +1,367 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+
+# コンパイル済みシナリオの拡張子
+EXTENSION = ".scn"
+
+MAGIC = b"TAES"
+FORMAT_VERSION = 2
+# マジックナンバー, 形式のバージョン, チェックサム, タイトル, 説明文,
+# 文字列数, シーン数, 選択肢数, 遷移先数
+HEADER = struct.Struct("<4sHxxIIIIIII")
+# 文字列の開始位置(文字列数 + 1 個並べて終了位置も兼ねる)
+OFFSET = struct.Struct("<I")
+# シーンID, 本文, 画像, 最初の選択肢, 選択肢数, エンディングフラグ
+SCENE = struct.Struct("<iIIIIB3x")
+# 本文, 最初の遷移先, 遷移先数
+SELECTION = struct.Struct("<III")
+# 遷移先のシーンID, 重み
+NEXT_ID = struct.Struct("<id")
+# 文字列が指定されていない場合の番号
+NO_STRING = 0xFFFFFFFF
+# エイリアステーブルの要素(遷移先のシーンID, 遷移先をそのまま選ぶ確率, 別名の位置)
+ALIAS = struct.Struct("<idI")
+
+
+def validate_json(data):
+    schema = {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string"},
+            "description": {"type": "string"},
+            "scenes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer"},
+                        "text": {"type": "string"},
+                        "image": {"type": "string"},
+                        "end": {"type": "boolean"},
+                        "selection": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "nextId": {
+                                        "oneOf": [
+                                            {"type": "integer"},
+                                            {
+                                                "type": "array",
+                                                "items": {
+                                                    "oneOf": [
+                                                        {"type": "integer"},
+                                                        {
+                                                            "type": "object",
+                                                            "properties": {
+                                                                "id": {
+                                                                    "type": "integer"
+                                                                },
+                                                                "weight": {
+                                                                    "type": "number",
+                                                                    "exclusiveMinimum": 0,
+                                                                },
+                                                            },
+                                                            "required": ["id"],
+                                                        },
+                                                    ]
+                                                },
+                                                "minItems": 1,
+                                            },
+                                        ]
+                                    },
+                                    "text": {"type": "string"},
+                                },
+                                "required": ["text", "nextId"],
+                            },
+                            "minItems": 0,
+                        },
+                    },
+                    "required": ["id", "text", "selection"],
+                    "if": {"properties": {"end": {"const": False}}},
+                    "then": {"properties": {"selection": {"minItems": 1}}},
+                },
+            },
+        },
+        "required": ["title", "description", "scenes"],
+    }
+    # jsonschemaは読み込みに時間がかかるため、取り込み時まで読み込まない
+    from jsonschema import SchemaError, ValidationError, validate
+
+    try:
+        validate(instance=data, schema=schema)
+    except ValidationError as e:
+        print(f"ValidationError: {e.message}")
+        raise e
+    except SchemaError as e:
+        print(f"SchemaError: {e.message}")
+        raise e
+
+
+def next_targets(next_id):
+    """選択肢の nextId を (遷移先のシーンID, 重み) の一覧にする"""
+    if isinstance(next_id, int):
+        return [(next_id, 1.0)]
+    return [
+        (target, 1.0)
+        if isinstance(target, int)
+        else (target["id"], float(target.get("weight", 1)))
+        for target in next_id
+    ]
+
+
+def build_alias_table(targets):
+    """重み付きの遷移先からエイリアステーブルを作成する(Vose's alias method)
+
+    遷移先を選ぶ際は乱数2つとテーブルの要素2つまでの参照で済む
+    """
+    count = len(targets)
+    total = sum(weight for _, weight in targets)
+    probabilities = [weight * count / total for _, weight in targets]
+    aliases = list(range(count))
+    small = [i for i, p in enumerate(probabilities) if p < 1]
+    large = [i for i, p in enumerate(probabilities) if p >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        aliases[less] = more
+        probabilities[more] -= 1 - probabilities[less]
+        (small if probabilities[more] < 1 else large).append(more)
+    # 誤差で残った要素は必ずそのまま選ばれるようにする
+    for i in small + large:
+        probabilities[i] = 1.0
+    return b"".join(
+        ALIAS.pack(target, probability, alias)
+        for (target, _), probability, alias in zip(targets, probabilities, aliases)
+    )
+
+
+def play_random(seed, step):
+    """プレイのシードと乱数の使用回数から [0, 1) の乱数を2つ生成する
+
+    同じシードと回数からは常に同じ値が得られるため、プレイを再現できる
+    """
+    digest = hashlib.blake2b(struct.pack("<qQ", seed, step), digest_size=16).digest()
+    first, second = struct.unpack("<QQ", digest)
+    return first / 2**64, second / 2**64
+
+
+def pick_next_scene(table, first, second):
+    """エイリアステーブルと乱数2つから遷移先のシーンIDを選ぶ"""
+    count = len(table) // ALIAS.size
+    index = min(int(first * count), count - 1)
+    target, probability, alias = ALIAS.unpack_from(table, ALIAS.size * index)
+    if second < probability:
+        return target
+    return ALIAS.unpack_from(table, ALIAS.size * alias)[0]
+
+
+def compile_scenario(data):
+    """検証済みのシナリオをコンパイル済みの形式のバイト列に変換する"""
+    strings = {}
+
+    def string(text):
+        if text is None:
+            return NO_STRING
+        return strings.setdefault(text, len(strings))
+
+    title = string(data["title"])
+    description = string(data["description"])
+    scenes = bytearray()
+    selections = bytearray()
+    next_ids = bytearray()
+    selection_count = 0
+    next_count = 0
+    for scene in data["scenes"]:
+        scenes += SCENE.pack(
+            scene["id"],
+            string(scene["text"]),
+            string(scene.get("image")),
+            selection_count,
+            len(scene["selection"]),
+            scene.get("end", False),
+        )
+        for selection in scene["selection"]:
+            targets = next_targets(selection["nextId"])
+            selections += SELECTION.pack(
+                string(selection["text"]), next_count, len(targets)
+            )
+            for target in targets:
+                next_ids += NEXT_ID.pack(*target)
+            selection_count += 1
+            next_count += len(targets)
+
+    # 文字列はUTF-8で連結し、開始位置の表から参照する
+    offsets = bytearray(OFFSET.pack(0))
+    text = bytearray()
+    for value in strings:
+        text += value.encode("utf-8")
+        offsets += OFFSET.pack(len(text))
+
+    body = bytes(offsets + scenes + selections + next_ids + text)
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        zlib.crc32(body),
+        title,
+        description,
+        len(strings),
+        len(data["scenes"]),
+        selection_count,
+        next_count,
+    )
+    return header + body
+
+
+def is_compiled(source):
+    """ファイルパスまたはバイト列がコンパイル済みのシナリオか判定する"""
+    if isinstance(source, (bytes, bytearray)):
+        return source[: len(MAGIC)] == MAGIC
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    return False
+
+
+class CompiledScenario:
+    """コンパイル済みのシナリオ
+
+    ファイルはメモリマップで読み込み、文字列やシーンは参照された時点で
+    マップ上の位置から直接取り出す
+    シーンの一覧として扱えるため、シナリオjsonの scenes の代わりに使用できる
+    """
+
+    def __init__(self, source):
+        self.mmap = None
+        if isinstance(source, (bytes, bytearray)):
+            self.buffer = memoryview(source)
+        else:
+            with open(source, "rb") as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self.mmap)
+
+        if len(self.buffer) < HEADER.size:
+            raise ValueError("Compiled scenario is truncated.")
+        (
+            magic,
+            version,
+            checksum,
+            self.title_index,
+            self.description_index,
+            string_count,
+            scene_count,
+            selection_count,
+            next_count,
+        ) = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Unsupported compiled scenario format.")
+        if zlib.crc32(self.buffer[HEADER.size :]) != checksum:
+            raise ValueError("Compiled scenario checksum mismatch.")
+
+        self.scene_count = scene_count
+        self.offsets = HEADER.size
+        self.scenes = self.offsets + OFFSET.size * (string_count + 1)
+        self.selections = self.scenes + SCENE.size * scene_count
+        self.next_ids = self.selections + SELECTION.size * selection_count
+        self.text = self.next_ids + NEXT_ID.size * next_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.buffer.release()
+        if self.mmap:
+            self.mmap.close()
+
+    def string(self, index):
+        if index == NO_STRING:
+            return None
+        position = self.offsets + OFFSET.size * index
+        start, end = struct.unpack_from("<II", self.buffer, position)
+        return str(self.buffer[self.text + start : self.text + end], "utf-8")
+
+    @property
+    def title(self):
+        return self.string(self.title_index)
+
+    @property
+    def description(self):
+        return self.string(self.description_index)
+
+    def __len__(self):
+        return self.scene_count
+
+    def __getitem__(self, index):
+        """シナリオjsonと同じ形式でシーンを取り出す"""
+        if not 0 <= index < self.scene_count:
+            raise IndexError(index)
+        scene_id, text, image, first, count, end = SCENE.unpack_from(
+            self.buffer, self.scenes + SCENE.size * index
+        )
+        selection = []
+        for i in range(first, first + count):
+            text_index, first_next, next_count = SELECTION.unpack_from(
+                self.buffer, self.selections + SELECTION.size * i
+            )
+            next_ids = [
+                dict(
+                    zip(
+                        ("id", "weight"),
+                        NEXT_ID.unpack_from(
+                            self.buffer, self.next_ids + NEXT_ID.size * j
+                        ),
+                    )
+                )
+                for j in range(first_next, first_next + next_count)
+            ]
+            selection.append({"nextId": next_ids, "text": self.string(text_index)})
+        return {
+            "id": scene_id,
+            "text": self.string(text),
+            "image": self.string(image),
+            "end": bool(end),
+            "selection": selection,
+        }
+
+    def as_dict(self):
+        """シナリオjsonと同じ形式で扱えるようにする(シーンは参照時に取り出す)"""
+        return {"title": self.title, "description": self.description, "scenes": self}
+
+
+def define_argparse():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser(
+        "compile", help="シナリオjsonファイルをコンパイル済みの形式に変換"
+    )
+    compile_parser.add_argument("scenarios", nargs="+", help="シナリオのjsonファイル")
+    compile_parser.add_argument(
+        "-o", "--output", help="出力先のフォルダ(省略時はjsonファイルと同じフォルダ)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = define_argparse()
+    for path in args.scenarios:
+        with open(path, "rb") as f:
+            data = json.load(f)
+        validate_json(data)
+        output = os.path.splitext(path)[0] + EXTENSION
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+            output = os.path.join(args.output, os.path.basename(output))
+        with open(output, "wb") as f:
+            f.write(compile_scenario(data))
+        print(f"Compiled scenario: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+import argparse
+import heapq
+import os
+import random
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import pathname2url
+
+from dotenv import load_dotenv
+
+from scenario_format import pick_next_scene
+
+load_dotenv()
+
+# 存在しないシーンへの遷移先を表す番号
+MISSING = -1
+# 消去法で使用する仮想の開始地点
+SOURCE = -2
+# 反復計算の上限までにエンディング等へ流出しきらなかった確率を表すキー
+UNRESOLVED = -3
+# 消去法で行う更新の回数の上限(超える成分は反復計算で求める)
+ELIMINATION_LIMIT = 5_000_000
+# 反復計算を打ち切る、成分内に残った確率の割合
+ITERATION_TOLERANCE = 1e-10
+# 反復計算で成分内のシーンを巡回する回数の上限
+ITERATION_LIMIT = 10_000
+
+
+def define_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", help="シナリオのIDまたはタイトル")
+    parser.add_argument(
+        "-d",
+        "--database",
+        default=os.getenv("DATABASE") or "engine.db",
+        help="データベースファイル名(スナップショットも指定可能)",
+    )
+    parser.add_argument(
+        "--version", type=int, help="シナリオのバージョン(省略時は公開中のバージョン)"
+    )
+    parser.add_argument(
+        "-n", "--playouts", type=int, default=10000, help="ランダムプレイの回数"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(), help="ランダムプレイの並列数"
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=10000,
+        help="ランダムプレイ1回あたりの選択回数の上限",
+    )
+    parser.add_argument("--seed", type=int, help="ランダムプレイの乱数のシード")
+    return parser.parse_args()
+
+
+class ScenarioGraph:
+    """シナリオのシーンを頂点、選択肢による遷移を辺とするグラフ
+
+    シーンは0から始まる番号で扱い、存在しないシーンへの遷移は MISSING に遷移する
+    """
+
+    def __init__(self, title, version_id, scene_ids, ends, choices, tables):
+        self.title = title
+        self.version_id = version_id
+        self.scene_ids = scene_ids
+        self.ends = ends
+        # シーンごとの選択肢の遷移先と確率 [[(遷移先, 確率), ...], ...]
+        self.choices = choices
+        # シーンごとの選択肢のエイリアステーブル
+        self.tables = tables
+        self.start = 0
+        self.index = {scene_id: i for i, scene_id in enumerate(scene_ids)}
+
+    def transitions(self, scene):
+        """選択肢を等確率で選んだ場合の遷移先ごとの確率"""
+        probabilities = {}
+        choices = self.choices[scene]
+        for targets in choices:
+            for target, probability in targets:
+                probability /= len(choices)
+                probabilities[target] = probabilities.get(target, 0) + probability
+        return probabilities
+
+    def label(self, scene):
+        return "missing" if scene == MISSING else str(self.scene_ids[scene])
+
+
+def load_scenario_graph(database, scenario, version_id=None):
+    """import_scenario で取り込んだシナリオをDBから読み込む"""
+    conn = sqlite3.connect(
+        f"file:{pathname2url(os.path.abspath(database))}?mode=ro", uri=True
+    )
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute(
+            "SELECT * FROM scenarios WHERE id = ? OR title = ?",
+            (int(scenario) if scenario.isdigit() else None, scenario),
+        ).fetchone()
+        if not row:
+            raise ValueError(f"Scenario not found: {scenario}")
+        version_id = version_id or row["current_version_id"]
+
+        scenes = conn.execute(
+            "SELECT id, scene_id, is_end FROM scenes WHERE version_id = ? ORDER BY scene_id",
+            (version_id,),
+        ).fetchall()
+        if not scenes:
+            raise ValueError(f"Scenario version not found: {version_id}")
+        scene_ids = [scene["scene_id"] for scene in scenes]
+        index = {scene_id: i for i, scene_id in enumerate(scene_ids)}
+        rows = {scene["id"]: i for i, scene in enumerate(scenes)}
+
+        choices = [[] for _ in scenes]
+        tables = [[] for _ in scenes]
+        selections = {}
+        for selection in conn.execute(
+            """
+            SELECT sel.id, sel.scene_id, sel.next_table
+            FROM selections sel
+            JOIN scenes s ON sel.scene_id = s.id
+            WHERE s.version_id = ?
+            ORDER BY sel.id
+            """,
+            (version_id,),
+        ):
+            scene = rows[selection["scene_id"]]
+            selections[selection["id"]] = []
+            choices[scene].append(selections[selection["id"]])
+            tables[scene].append(selection["next_table"])
+
+        weights = {}
+        for next_scene in conn.execute(
+            """
+            SELECT ns.selection_id, ns.next_id, ns.weight
+            FROM next_scenes ns
+            JOIN selections sel ON ns.selection_id = sel.id
+            JOIN scenes s ON sel.scene_id = s.id
+            WHERE s.version_id = ?
+            ORDER BY ns.id
+            """,
+            (version_id,),
+        ):
+            selection_id = next_scene["selection_id"]
+            target = index.get(next_scene["next_id"], MISSING)
+            selections[selection_id].append((target, next_scene["weight"]))
+            weights[selection_id] = weights.get(selection_id, 0) + next_scene["weight"]
+        for selection_id, targets in selections.items():
+            targets[:] = [
+                (target, weight / weights[selection_id]) for target, weight in targets
+            ]
+
+        return ScenarioGraph(
+            row["title"],
+            version_id,
+            scene_ids,
+            [bool(scene["is_end"]) for scene in scenes],
+            choices,
+            tables,
+        )
+    finally:
+        conn.close()
+
+
+def strongly_connected_components(successors, start):
+    """開始地点から到達できる強連結成分を後ろの成分から順に返す(Tarjanの方法)"""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    counter = 0
+    work = [(start, iter(successors(start)))]
+    index[start] = lowlink[start] = counter
+    counter += 1
+    stack.append(start)
+    on_stack.add(start)
+    while work:
+        node, children = work[-1]
+        for child in children:
+            if child not in index:
+                index[child] = lowlink[child] = counter
+                counter += 1
+                stack.append(child)
+                on_stack.add(child)
+                work.append((child, iter(successors(child))))
+                break
+            if child in on_stack:
+                lowlink[node] = min(lowlink[node], index[child])
+        else:
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+def eliminate(component, transitions, mass):
+    """閉路を含む成分に流入した確率が成分の外へ流出する確率を求める
+
+    成分内のシーンを次数の小さいものから順に消去し、消去したシーンを経由する
+    遷移を前後のシーンの間の遷移に置き換える(自己遷移は等比級数でまとめる)
+    遷移の置き換えが ELIMINATION_LIMIT 回を超える場合は None を返す
+    """
+    members = set(component)
+    out = {node: dict(transitions[node]) for node in component}
+    out[SOURCE] = {node: mass[node] for node in component if mass.get(node)}
+    inn = {node: set() for node in component}
+    for node, targets in out.items():
+        for target in targets:
+            if target in members:
+                inn[target].add(node)
+
+    def degree(node):
+        return len(inn[node]) * len(out[node])
+
+    # 消去による次数の変化は取り出した時点で確認する(近似的な最小次数順)
+    heap = [(degree(node), node) for node in component]
+    heapq.heapify(heap)
+    updates = 0
+    while heap:
+        current, node = heapq.heappop(heap)
+        if current != degree(node):
+            heapq.heappush(heap, (degree(node), node))
+            continue
+        updates += current
+        if updates > ELIMINATION_LIMIT:
+            return None
+        members.discard(node)
+        targets = out.pop(node)
+        # 自己遷移の確率を 1 から引くと、1 に近い場合に桁落ちするため
+        # 残りの遷移先の確率の和で割る(Grassmann-Taksar-Heymanの方法)
+        targets.pop(node, None)
+        total = sum(targets.values())
+        if not total:
+            # 流出する確率が浮動小数点数で表せないほど小さい
+            return None
+        scale = 1 / total
+        predecessors = inn.pop(node)
+        predecessors.discard(node)
+        for target in targets:
+            if target in members:
+                inn[target].discard(node)
+        for predecessor in predecessors:
+            successors = out[predecessor]
+            probability = successors.pop(node) * scale
+            for target, target_probability in targets.items():
+                successors[target] = (
+                    successors.get(target, 0) + probability * target_probability
+                )
+                if target in members:
+                    inn[target].add(predecessor)
+    return out[SOURCE]
+
+
+def iterate(component, transitions, mass):
+    """成分に流入した確率を成分内で繰り返し遷移させ、成分の外へ流出する確率を求める
+
+    消去法では遷移の置き換えが多すぎる成分に使用する(ガウス・ザイデル法)
+    成分内に残った確率の割合が ITERATION_TOLERANCE を下回るか、巡回が
+    ITERATION_LIMIT 回に達した時点で打ち切り、残りは UNRESOLVED として返す
+    """
+    local = {node: i for i, node in enumerate(component)}
+    inside = []
+    leaving = []
+    for node in component:
+        inside.append(
+            [
+                (local[target], probability)
+                for target, probability in transitions[node].items()
+                if target in local
+            ]
+        )
+        leaving.append(
+            [
+                (target, probability)
+                for target, probability in transitions[node].items()
+                if target not in local
+            ]
+        )
+    residual = [mass.get(node, 0) for node in component]
+    exited = [0.0] * len(component)
+    inflow = sum(residual)
+    for _ in range(ITERATION_LIMIT):
+        for i, edges in enumerate(inside):
+            amount = residual[i]
+            if not amount:
+                continue
+            residual[i] = 0.0
+            exited[i] += amount
+            for j, probability in edges:
+                residual[j] += amount * probability
+        if sum(residual) <= inflow * ITERATION_TOLERANCE:
+            break
+
+    # exited には成分内への遷移も含むため、成分外への遷移の確率だけを掛ける
+    outflow = {UNRESOLVED: sum(residual)}
+    for i, edges in enumerate(leaving):
+        for target, probability in edges:
+            outflow[target] = outflow.get(target, 0) + exited[i] * probability
+    return outflow
+
+
+def ending_probabilities(graph):
+    """選択肢を等確率で選んだ場合に各エンディングへ到達する確率
+
+    強連結成分を開始地点に近い順に処理し、閉路の無い部分は確率をそのまま次のシーンへ
+    流し、閉路を含む成分は消去法(大きすぎる場合は反復計算)で成分から
+    流出する確率を求める
+    終わりの無い閉路に入ってしまう確率は None をキーとして返す
+    """
+    transitions = {}
+
+    def successors(node):
+        if node == MISSING or graph.ends[node]:
+            return []
+        if node not in transitions:
+            transitions[node] = graph.transitions(node)
+        return list(transitions[node])
+
+    components = strongly_connected_components(successors, graph.start)
+    mass = {graph.start: 1.0}
+    results = Counter()
+    for component in reversed(components):
+        node = component[0]
+        if len(component) == 1 and node not in transitions.get(node, {}):
+            amount = mass.pop(node, 0)
+            if node == MISSING or graph.ends[node]:
+                results[node] += amount
+            elif not transitions.get(node):
+                results[None] += amount
+            else:
+                for target, probability in transitions[node].items():
+                    mass[target] = mass.get(target, 0) + amount * probability
+            continue
+
+        members = set(component)
+        exits = any(
+            target not in members for node in component for target in transitions[node]
+        )
+        if not exits:
+            results[None] += sum(mass.pop(node, 0) for node in component)
+            continue
+        outflow = eliminate(component, transitions, mass)
+        if outflow is None:
+            outflow = iterate(component, transitions, mass)
+        for target, amount in outflow.items():
+            mass[target] = mass.get(target, 0) + amount
+        for node in component:
+            mass.pop(node, None)
+    if UNRESOLVED in mass:
+        results[UNRESOLVED] += mass.pop(UNRESOLVED)
+    return results
+
+
+def path_lengths(graph):
+    """各シーンへの最短の選択回数、最長の選択回数、経路数
+
+    最長の選択回数と経路数は強連結成分を縮約したグラフで数え、途中でループを
+    通れるシーンは選択回数も経路も限りがないため None とする
+    """
+    successors = [
+        sorted({target for targets in graph.choices[scene] for target, _ in targets})
+        if not graph.ends[scene]
+        else []
+        for scene in range(len(graph.scene_ids))
+    ]
+
+    def next_scenes(node):
+        return successors[node] if node != MISSING else []
+
+    shortest = {graph.start: 0}
+    queue = [graph.start]
+    for node in queue:
+        for target in next_scenes(node):
+            if target not in shortest:
+                shortest[target] = shortest[node] + 1
+                queue.append(target)
+
+    # 成分は後ろから順に求まるため、逆順にたどると遷移元の成分が先になる
+    longest = {graph.start: 0}
+    paths = {graph.start: 1}
+    for component in reversed(strongly_connected_components(next_scenes, graph.start)):
+        node = component[0]
+        if len(component) > 1 or node in next_scenes(node):
+            for member in component:
+                longest[member] = paths[member] = None
+        for member in component:
+            for target in next_scenes(member):
+                if longest.get(target, 0) is None:
+                    continue
+                if longest[member] is None:
+                    longest[target] = paths[target] = None
+                else:
+                    longest[target] = max(longest.get(target, 0), longest[member] + 1)
+                    paths[target] = paths.get(target, 0) + paths[member]
+    return shortest, longest, paths
+
+
+def init_worker(graph):
+    global worker_graph
+    worker_graph = graph
+
+
+def run_playouts(seed, count, max_steps):
+    """選択肢を等確率で選ぶランダムプレイを行い、到達したシーンを数える"""
+    graph = worker_graph
+    rng = random.Random(seed)
+    results = Counter()
+    total_steps = 0
+    for _ in range(count):
+        scene = graph.start
+        steps = 0
+        while scene != MISSING and not graph.ends[scene] and steps < max_steps:
+            tables = graph.tables[scene]
+            if not tables:
+                break
+            table = tables[int(rng.random() * len(tables))]
+            next_id = pick_next_scene(table, rng.random(), rng.random())
+            scene = graph.index.get(next_id, MISSING)
+            steps += 1
+        if scene == MISSING or graph.ends[scene]:
+            results[scene] += 1
+        else:
+            results[None] += 1
+        total_steps += steps
+    return results, total_steps
+
+
+def simulate(graph, playouts, workers, max_steps, seed=None):
+    """ランダムプレイをプロセスプールで並列に行う"""
+    if playouts <= 0:
+        return Counter(), 0
+    rng = random.Random(seed)
+    chunks = max(1, min(playouts, workers * 4))
+    counts = [playouts // chunks + (i < playouts % chunks) for i in range(chunks)]
+    results = Counter()
+    total_steps = 0
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(graph,)
+    ) as executor:
+        futures = [
+            executor.submit(run_playouts, rng.getrandbits(64), count, max_steps)
+            for count in counts
+        ]
+        for future in futures:
+            chunk_results, chunk_steps = future.result()
+            results.update(chunk_results)
+            total_steps += chunk_steps
+    return results, total_steps
+
+
+def format_longest(longest):
+    return "loop" if longest is None else longest
+
+
+def format_count(count):
+    """経路数は桁数が非常に大きくなるため、大きい場合は指数表記にする"""
+    if count < 10**15:
+        return str(count)
+    exponent = int((count.bit_length() - 1) * 0.30102999566398)
+    mantissa = count / 10**exponent
+    if mantissa >= 10:
+        mantissa, exponent = mantissa / 10, exponent + 1
+    return f"{mantissa:.3f}e+{exponent}"
+
+
+def main():
+    args = define_argparse()
+    started = time.perf_counter()
+    try:
+        graph = load_scenario_graph(args.database, args.scenario, args.version)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    loaded = time.perf_counter()
+    probabilities = ending_probabilities(graph)
+    shortest, longest, paths = path_lengths(graph)
+    analyzed = time.perf_counter()
+    playouts, total_steps = simulate(
+        graph, args.playouts, args.workers, args.max_steps, args.seed
+    )
+    finished = time.perf_counter()
+
+    endings = [scene for scene in range(len(graph.scene_ids)) if graph.ends[scene]]
+    reachable = [scene for scene in shortest if scene != MISSING]
+    print(f"Scenario: {graph.title} (version {graph.version_id})")
+    print(
+        f"Scenes: {len(graph.scene_ids)}"
+        f" (reachable {len(reachable)}, endings {len(endings)})"
+    )
+    targets = [scene for scene in endings + [MISSING] if scene in paths]
+    looping = sum(1 for scene in targets if paths[scene] is None)
+    print(
+        "Distinct paths: "
+        f"{format_count(sum(paths[scene] or 0 for scene in targets))}"
+        + (f" (unbounded through loops to {looping} endings)" if looping else "")
+    )
+    print()
+    print(
+        f"{'Ending':>10} {'Probability':>12}"
+        f" {'Shortest':>9} {'Longest':>9} {'Playouts':>9}"
+    )
+    for scene in endings + ([MISSING] if MISSING in shortest else []):
+        print(
+            f"{graph.label(scene):>10}"
+            f" {probabilities.get(scene, 0):>12.6f}"
+            f" {shortest.get(scene, '-'):>9}"
+            f" {format_longest(longest.get(scene, '-')):>9}"
+            f" {playouts.get(scene, 0) / max(args.playouts, 1):>9.4f}"
+        )
+    print(
+        f"{'no ending':>10} {probabilities.get(None, 0):>12.6f} {'-':>9} {'-':>9}"
+        f" {playouts.get(None, 0) / max(args.playouts, 1):>9.4f}"
+    )
+    if probabilities.get(UNRESOLVED):
+        print(f"{'unresolved':>10} {probabilities[UNRESOLVED]:>12.6f}")
+    if args.playouts > 0:
+        print()
+        print(f"Average selections per playout: {total_steps / args.playouts:.2f}")
+    print(
+        f"Time: load {loaded - started:.3f}s, analysis {analyzed - loaded:.3f}s,"
+        f" playouts {finished - analyzed:.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
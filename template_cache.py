@@ -0,0 +1,23 @@
+import hashlib
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """テンプレート名をキーとするバイトコードキャッシュ
+
+    Jinja標準のキーはテンプレートの絶対パスを含むため、実行ファイルの展開先が
+    起動のたびに変わるとキャッシュが使えない
+    テンプレートの内容が変わった場合はJinjaがソースのハッシュで検出して再コンパイルする
+    """
+
+    def get_cache_key(self, name, filename=None):
+        return hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+
+def warm_template_cache(jinja_env):
+    """全テンプレートをコンパイルしてバイトコードキャッシュに書き込む"""
+    names = jinja_env.list_templates()
+    for name in names:
+        jinja_env.get_template(name)
+    return names